@@ -165,7 +165,7 @@ class MainPanel(wx.Panel):
                 try:
                     summary = rfprediction.execute_analysis(training_file=fn_t,
                         diagnosis_file=fn_i,
-                        mum_trees=num_trees,
+                        num_trees=num_trees,
                         max_depth=max_depth,
                         id_field=id_column,
                         output_field=output_column,
@@ -8,6 +8,7 @@ var express = require('express')
   , http = require('http')
   , child_process = require('child_process')
   , fs = require('fs')
+  , os = require('os')
   , path = require('path');
 
 var aicsvr = require('./dblibs.js');
@@ -20,6 +21,7 @@ var app = express();
 var filename_db = 'db/datastore.db';
 var table_db = 'processed_data';
 var table_model = 'saved_model';
+var table_profile = 'job_profile';
 var port_number = 8091;
 var accept_url = 'result';
 var error_url = 'index';
@@ -29,6 +31,13 @@ var server = null;
 
 var page_parameters = {title:'aiCluster webservice', author:'Takaho A. Endo', message:null, key:null};
 var python_program = 'rfprediction.py'
+var num_workers = Math.max(1, Math.min(4, os.cpus().length));
+var worker_pool = [];
+var worker_queue = [];
+var worker_job_id = 0;
+var table_cache = 'db/tablecache';
+var profile_jobs = false;
+var model_files = {}; // model id : {filename:temporary file used by workers, date:date of the stored model}
 
 var __defaults = {num_trees:20, tree_depth:4, field_id:'ID', field_out:'OUT'};
 var __verbose = false;
@@ -122,7 +131,7 @@ function process_data(req, res) {
 //    console.log(analysisfile);
 //    process.exit();
     //var modelfile = 'sqlite:' + filename_db + ':' + table_model + ':' + req.body.model;
-    options = [python_program, '-i', analysisfile];
+    options = ['-i', analysisfile];
     //res.end();
 //    console.log(options);
     aicsvr.save_model_file(filename_db, table_db, req.body.model,
@@ -168,7 +177,7 @@ function process_data(req, res) {
     if (typeof field_id !== 'string' || field_id === '') {field_id = __defaults.field_id; }
     if (typeof field_out !== 'string' || field_out === '') { field_out = __defaults.field_out; }
 
-    var options = [python_program, '-t', trainingfile,
+    var options = ['-t', trainingfile,
     '-d', tree_depth, '-n', num_trees, '-F', field_out, '-I', field_id];
     //, '--verbose'];
     if (typeof iteration !== 'undefined' && 1 < iteration && iteration <= 1000) {
@@ -197,6 +206,122 @@ function __respond_to_client(err, key, res) {
   }
 }
 
+/**
+  Start a python worker which processes jobs given as JSON lines.
+  Workers keep modules and recently used models loaded, and score records of predictions by compiled trees.
+**/
+function __start_worker(index) {
+  var options = [python_program, '--serve', '--compiled'];
+  if (table_cache) { // keeps sources of compiled trees
+    options.push('--cache');
+    options.push(table_cache);
+  }
+  var proc = child_process.spawn('python', options);
+  var worker = {proc:proc, job:null, buffer:'', reserved:(index === num_workers)};
+  proc.stdout.on('data', function(data) {
+    worker.buffer += data.toString();
+    var pos;
+    while ((pos = worker.buffer.indexOf('\n')) >= 0) {
+      var line = worker.buffer.slice(0, pos);
+      worker.buffer = worker.buffer.slice(pos + 1);
+      if (line.length === 0) {
+        continue;
+      }
+      var response;
+      try {
+        response = JSON.parse(line);
+      } catch (e) {
+        response = {status:'error', error:'invalid response : ' + line};
+      }
+      var job = worker.job;
+      worker.job = null;
+      if (job !== null) {
+        job.callback(response.status === 'success' ? null : response.error, response);
+      }
+      __dispatch_jobs();
+    }
+  });
+  proc.stderr.on('data', function(data) {
+    if (__verbose) {
+      process.stderr.write(data);
+    }
+  });
+  proc.on('exit', function(code) {
+    process.stderr.write('worker ' + index + ' exited with code ' + code + '\n');
+    var job = worker.job;
+    worker.job = null;
+    worker_pool[index] = null;
+    if (job !== null) {
+      job.callback('worker exited with code ' + code, null);
+    }
+    // restart later not to loop when python is not available
+    setTimeout(function() {
+      worker_pool[index] = __start_worker(index);
+      __dispatch_jobs();
+    }, 1000);
+  });
+  return worker;
+}
+
+/**
+  Start workers of the pool and a worker reserved for predictions of records,
+  which are not blocked by long calculations.
+**/
+function __start_workers() {
+  for (var i = 0; i <= num_workers; i++) {
+    worker_pool.push(__start_worker(i));
+  }
+}
+
+/**
+  Send queued jobs to idle workers. Predictions are sent first, to the reserved worker if it is idle.
+  Other jobs are not sent to the reserved worker.
+**/
+function __dispatch_jobs() {
+  var workers = worker_pool.slice().reverse(); // the reserved worker first
+  for (var i = 0; i < workers.length && worker_queue.length > 0; i++) {
+    var worker = workers[i];
+    if (worker === null || worker.job !== null) {
+      continue;
+    }
+    var index = -1;
+    for (var j = 0; j < worker_queue.length; j++) {
+      if (worker_queue[j].prediction || !worker.reserved) {
+        index = j;
+        break;
+      }
+    }
+    if (index >= 0) {
+      var job = worker_queue.splice(index, 1)[0];
+      worker.job = job;
+      worker.proc.stdin.write(JSON.stringify(job.message) + '\n');
+    }
+  }
+}
+
+/**
+  Queue a job for workers with command line options of rfprediction.py.
+  Callback receives error and the response of the worker.
+**/
+function __submit_job(options, callback) {
+  worker_job_id++;
+  worker_queue.push({id:worker_job_id, message:{id:worker_job_id, args:options}, callback:callback});
+  __dispatch_jobs();
+}
+
+/**
+  Queue scoring of records with a model file ahead of other jobs since it finishes in milliseconds.
+  Callback receives error and predictions of records.
+**/
+function __submit_prediction(filename_model, records, callback) {
+  worker_job_id++;
+  var message = {id:worker_job_id, command:'predict', model:filename_model, records:records};
+  worker_queue.unshift({id:worker_job_id, message:message, prediction:true, callback:function(err, response) {
+    callback(err, response ? response.predictions : null);
+  }});
+  __dispatch_jobs();
+}
+
 function __spawn_rfprogram(options, callback) {
 //  console.log(analysisfile);
   // This process reserve a unique key before calculation.
@@ -217,32 +342,39 @@ function __spawn_rfprogram(options, callback) {
       var filename_output = temp.path({suffix:'.json'});
       options.push('-o');
       options.push(filename_output);
+      options.push('--compact'); // stored in database as is
+      options.push('--without-binary-model'); // models are exported from the database for predictions
+      if (table_cache) { // uploaded reference data are often the same
+        options.push('--cache');
+        options.push(table_cache);
+      }
+      if (profile_jobs) {
+        options.push('--profile');
+      }
 
 //      console.log(options.join(' '));
 //      console.log('CALLBACK with ' + key);
       callback(null, key);
 
-      var proc = child_process.spawn('python', options);
-      proc.stdout.on('data', function(data) {
-        if (__verbose) {
-          process.stdout.write(data);
-        }
-      });
-      proc.stderr.on('data', function(data) {
-        if (__verbose) {
-          process.stderr.write(data);
-        }
-      });
-      proc.stdout.on('close', function(err) {
+      __submit_job(options, function(err, response) {
         if (err) {
-          if (__verbose) {
-            process.stderr.write('ERROR in execution : ' + err + '\n');
-          }
-//          callback(err, key);
+          process.stderr.write('ERROR in execution of ' + key + ' : ' + err + '\n');
+          aicsvr.save_data(filename_db, table_db, {key:key, state:-1}, function(err) {
+            if (err) {
+              process.stderr.write('failed to set failure flag on ' + key + ' : ' + err + '\n');
+            }
+          });
         } else {
           if (__verbose) {
             process.stderr.write('finished ' + key + ', saving to database\n');
           }
+          if (response && response.profile) {
+            aicsvr.save_profile(filename_db, table_profile, key, response.profile, function(err) {
+              if (err) {
+                process.stderr.write('failed to save profile of ' + key + ' : ' + err + '\n');
+              }
+            });
+          }
           var data = fs.readFile(filename_output, function(err, data) {
             //__remove_temporary_files([filename_output]);
             if (err) { // error
@@ -265,18 +397,6 @@ function __spawn_rfprogram(options, callback) {
               });
             }});
           }});
-
-
-
-      // if (format == 'json') {
-      //   send_json_message(res, {error:null, key:key});
-      // } else {
-      //   res.writeHead(301, {location:'/result?id=' + key});
-      //   // var params = get_parameters();
-      //   // params.key = key;
-      //   // res.render(accept_url, params);
-      // }
-      // res.end();
     }
   });
 }
@@ -364,10 +484,97 @@ function get_model_fields(req, res) {
 
 };
 
+/**
+Score records given as JSON {model:id, records:[{field:value, ...}, ...]} (or a record)
+with a model in the database without uploading files.
+Responds [{group, prediction, score, best_tree}, ...]
+*/
+function predict_records(req, res) {
+  var model_id = req.body.model;
+  var records = req.body.records;
+  if (typeof records === 'string') {
+    try {
+      records = JSON.parse(records);
+    } catch (e) {
+      records = null;
+    }
+  }
+  if (!model_id || !records) {
+    res.writeHead(400, {'Content-Type':'text/plain'});
+    res.write('model and records are required');
+    res.end();
+    return;
+  }
+  var respond = function(err, predictions) {
+    if (err) {
+      res.writeHead(500, {'Content-Type':'text/plain'});
+      res.write('prediction failed : ' + err);
+      res.end();
+    } else {
+      res.writeHead(200, {'Content-Type':'aplication/json'});
+      res.write(JSON.stringify(predictions));
+      res.end();
+    }
+  };
+  // the exported file is reused while the stored model has the same date and the file exists
+  aicsvr.get_data_date(filename_db, table_db, model_id, function(err, date) {
+    if (err || date === null) {
+      __forget_model_file(model_id);
+      res.writeHead(err ? 500 : 404, {'Content-Type':'text/plain'});
+      res.write('could not retrieve models having id:' + model_id);
+      res.end();
+      return;
+    }
+    var entry = model_files[model_id];
+    if (entry && entry.date === date && fs.existsSync(entry.filename)) {
+      __submit_prediction(entry.filename, records, respond);
+      return;
+    }
+    __forget_model_file(model_id);
+    aicsvr.save_model_file(filename_db, table_db, model_id, function(err, filename_tmp, date) {
+      if (err) {
+        res.writeHead(500, {'Content-Type':'text/plain'});
+        res.write('could not retrieve models having id:' + model_id);
+        res.end();
+      } else {
+        model_files[model_id] = {filename:filename_tmp, date:date}; // workers keep the model loaded
+        __submit_prediction(filename_tmp, records, respond);
+      }
+    });
+  });
+};
+
+/** Remove the temporary file of a model exported for predictions */
+function __forget_model_file(model_id) {
+  var entry = model_files[model_id];
+  if (entry) {
+    delete model_files[model_id];
+    __remove_temporary_files(entry.filename);
+  }
+}
+
+/**
+Provide profiles of jobs recorded with --profile, the query "since" limits the date
+*/
+function get_profiles(req, res) {
+  aicsvr.get_profiles(filename_db, table_profile, req.query['since'], function(err, profiles) {
+    if (err) {
+      res.writeHead(500, {'Content-Type':'text/plain'});
+      res.write('could not retrieve profiles');
+      res.end();
+    } else {
+      res.writeHead(200, {'Content-Type':'aplication/json'});
+      res.write(JSON.stringify(profiles));
+      res.end();
+    }
+  });
+};
+
 // save or remove
 function manage_model(req, res) {
   var model_id = req.query['model_id'];
   var command = req.query['command'];
+  __forget_model_file(model_id); // predictions export the model again
   res.end();
 };
 
@@ -443,6 +650,9 @@ Commands
  --db                     : database path (SQLite)
  --port [number]          : port number
  --verbose                : verbosity
+ --workers [number]       : number of python workers
+ --table-cache [directory]: directory to cache parsed tables, 'none' to disable
+ --profile                : record time and peak RSS of stages of each job
 **/
 
 for (var i = 0; i < process.argv.length; i++) {
@@ -458,6 +668,13 @@ for (var i = 0; i < process.argv.length; i++) {
     pure_server = true;
   } else if (arg === '--admin-host') {
     admin_host = process.argv[++i];
+  } else if (arg === '--workers') {
+    num_workers = Math.max(1, parseInt(process.argv[++i], 10) || 1);
+  } else if (arg === '--table-cache') {
+    table_cache = process.argv[++i];
+    if (table_cache === 'none') {table_cache = null;}
+  } else if (arg === '--profile') {
+    profile_jobs = true;
   }
 }
 
@@ -490,12 +707,22 @@ app.get('/result', display_results);
 app.get('/models', get_models);
 app.get('/feature', get_model_fields);
 app.get('/admin', process_command);
+app.get('/profiles', get_profiles);
 
 app.post('/', process_data);
 app.post('/predict', predict_data);
 app.post('/save', save_model);
+app.post('/predict_one', predict_records);
 
 aicsvr.verbose(__verbose);
+__start_workers();
+process.on('exit', function() {
+  for (var i = 0; i < worker_pool.length; i++) {
+    if (worker_pool[i] !== null) {
+      worker_pool[i].proc.kill();
+    }
+  }
+});
 
 server = http.createServer(app).listen(app.get('port'), function(){
   aicsvr.setup_db(filename_db, table_db, table_model, function(err) {
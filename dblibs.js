@@ -9,6 +9,7 @@ var __states = {SUCCESS:1, READY:0, FAILURE:-1};
 var __expire_period = 1000 * 60 * 60 * 24 * 180;
 var __default_table_data = 'repository';
 var __default_table_model = 'saved_model';
+var __default_table_profile = 'job_profile';
 var __key_characters = "0123456789abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ";
 
 /*****
@@ -186,6 +187,58 @@ function open_model_database(filename, table, callback) {
 }
 
 
+/**
+  Open database connection of job profiles and call callback function.
+  Parameters:
+    filename : SQLite filename (default in-memory database)
+    table    : SQLite table (default __default_table_profile)
+**/
+function open_profile_database(filename, table, callback) {
+  if (typeof filename === 'undefined') {
+    filename = ':memory:';
+  } else if (!fs.existsSync(filename)) {
+    __create_dir(path.dirname(filename));
+  }
+  if (typeof table === 'undefined') { table = __default_table_profile; }
+  if (__verbose) {process.stderr.write('OPEINING : ' + table + '\n'); }
+  var db = new sqlite3.Database(filename,
+    function(err) {
+      db.get('select name from sqlite_master where name=?', table,
+        function(err, row) {
+          if (err === null) {
+            if (!row) {
+              if (__already_created_tables[table]) {
+                if (__verbose) {
+                  process.stderr.write('waiting for ' + table + ' is ready');
+                }
+                setTimeout(function(){open_profile_database(filename, table, callback);}, 100);
+              } else {
+                if (__verbose) {
+                  process.stderr.write('creating table\n');
+                }
+                db.serialize(function() {
+                  db.run('create table ' + table + ' (id primary key not null, date, wall real, cpu real, max_rss int8, profile text not null)');
+                  db.run('create index index_' + table + '_date on ' + table + '(date)');
+                  db.close();
+                  __already_created_tables[table] = true;
+                  setTimeout(function(){open_profile_database(filename, table, callback);}, 10);
+                });
+              }
+            } else {
+              if (__verbose) { process.stderr.write(table + ' is set up\n'); }
+              __already_created_tables[table] = true;
+              callback(null, db);
+            }
+          } else {
+            if (!db) { db.close(); }
+            callback(err);
+          }
+        }
+      );
+    }
+  );
+}
+
 /**
   This function is used once after spawing the process.
   Set up database and create a file and a table if there are no database.
@@ -304,6 +357,60 @@ function save_data(filename, table, contents, callback) {
   });
 }
 
+/**
+  Save stages of a job given by rfprediction.py --profile.
+  Totals of outermost stages are kept in columns to track regressions.
+**/
+function save_profile(filename, table, key, profile, callback) {
+  var date = dateformat(Date(), 'isoUtcDateTime');
+  var wall = 0, cpu = 0, max_rss = 0;
+  for (var i = 0; i < profile.length; i++) {
+    if (profile[i].depth === 0) {
+      wall += profile[i].wall || 0;
+      cpu += profile[i].cpu || 0;
+    }
+    max_rss = Math.max(max_rss, profile[i].max_rss || 0);
+  }
+  open_profile_database(filename, table, function(err, db) {
+    if (err) {
+      callback(err);
+      if (db) { db.close(); }
+    } else {
+      db.run('insert or replace into ' + table + ' values(?, ?, ?, ?, ?, ?)', key, date, wall, cpu, max_rss, JSON.stringify(profile),
+        function(err) {
+          if (err && __verbose) {process.stderr.write('ERROR ' + err);}
+          db.close();
+          callback(err);
+        });
+    }
+  });
+}
+
+/**
+  Retrieve profiles of jobs recorded after the date (ISO format, all if not given), newest first.
+**/
+function get_profiles(filename, table, since, callback) {
+  open_profile_database(filename, table, function(err, db) {
+    if (err) {
+      callback(err);
+      if (db) { db.close(); }
+    } else {
+      db.all('select * from ' + table + ' where date >= ? order by date desc', since || '',
+        function(err, rows) {
+          var profiles = [];
+          if (err === null) {
+            for (var i = 0; i < rows.length; i++) {
+              profiles.push({key:rows[i].id, date:rows[i].date, wall:rows[i].wall, cpu:rows[i].cpu,
+                max_rss:rows[i].max_rss, profile:JSON.parse(rows[i].profile)});
+            }
+          }
+          db.close();
+          callback(err, profiles);
+        });
+    }
+  });
+}
+
 /***
   Save a calculated model for prediction of other data
   CREATE TABLE __saved__ (ID not null primary key, NAME, USER, DATE, FOREST blob, BEST blob);
@@ -469,25 +576,50 @@ function load_data(filename, table, key, callback) {
   });
 }
 
+/**
+  Write data of a key into a temporary JSON file.
+  Callback receives error, the filename and the date of the data.
+**/
 function save_model_file(filename, table, key, callback) {
   open_database(filename, table, function(err, db) {
     if (err) {
-      db.close();
+      if (db) {db.close();}
       callback(err);
+      return;
     }
-    db.get('select data from ' + table + ' where id=?', key,
+    db.get('select date, data from ' + table + ' where id=?', key,
       function(err, row) {
-        if (err) {
-          callback(err);
-        }
         db.close();
+        if (err || !row) {
+          callback(err || 'no data ID : ' + key);
+          return;
+        }
         var ft = temp.path({suffix:'.json'});
         var fd = fs.openSync(ft, 'w');
 //        console.log(row.data.toString());
         fs.writeSync(fd, row.data.toString(), {encoding:'utf-8'});
         fs.closeSync(fd);
 //        console.log('temporary filename ' + ft);
-        callback(null, ft);
+        callback(null, ft, row.date);
+      }
+    );
+  });
+}
+
+/**
+  Provide the date of data of a key, callback receives error and the date (null if the key is not stored).
+**/
+function get_data_date(filename, table, key, callback) {
+  open_database(filename, table, function(err, db) {
+    if (err) {
+      if (db) {db.close();}
+      callback(err);
+      return;
+    }
+    db.get('select date from ' + table + ' where id=?', key,
+      function(err, row) {
+        db.close();
+        callback(err, row ? row.date : null);
       }
     );
   });
@@ -538,6 +670,9 @@ exports.load_data = load_data;
 exports.verbose = verbose;
 exports.save_model = save_model;
 exports.save_model_file = save_model_file;
+exports.get_data_date = get_data_date;
 exports.get_models = get_models;
 exports.get_model_fields = get_model_fields;
+exports.save_profile = save_profile;
+exports.get_profiles = get_profiles;
 exports.PROCESSING_STATES = __states;
@@ -333,6 +333,25 @@ aic.__create_canvas = function(width, height) {
   return cnv;
 }
 
+/**
+  Convert a tree in columnar form into an array of nodes.
+  Trees saved by older versions are already arrays.
+*/
+aic.__expand_tree = function(tree) {
+  if (Array.isArray(tree)) { return tree; }
+  var nodes = [];
+  for (var i = 0; i < tree.children_left.length; i++) {
+    var left = tree.children_left[i];
+    if (left < 0) {
+      nodes.push({id:i, value:tree.value[i], x:tree.x[i], y:tree.y[i], leaf:true});
+    } else {
+      nodes.push({id:i, x:tree.x[i], y:tree.y[i], children:[left, tree.children_right[i]],
+        feature:tree.feature[i], threshold:tree.threshold[i], leaf:false});
+    }
+  }
+  return nodes;
+}
+
 /**
   Draw a representative tree in CANVAS element.
 */
@@ -343,7 +362,7 @@ aic.draw_best_tree = function(data) {
   var height = size;
   var labels = data.group_label;
   var fields = data.field;
-  var tree = data.best_tree;
+  var tree = aic.__expand_tree(data.best_tree);
   var i, j;
   var xmax = 0;
   var ymax = 0;
@@ -559,7 +578,18 @@ aic.create_prediction_table = function(data) {
 */
 aic.create_weight_table = function(data) {
   var table = $('<table>').attr('id', 'weight_table');
-  $('<tr>').append($('<th>').text('Property')).append($('<th>').text('Loading')).appendTo(table);
+  var header = $('<tr>').append($('<th>').text('Property')).append($('<th>').text('Loading')).appendTo(table);
+  var importance = data.importance || {};
+  var measures = [['impurity', 'Impurity', 'darkgreen'], ['permutation', 'Permutation', 'chocolate']].filter(function(m) {return importance[m[0]];});
+  var importance_max = {};
+  for (var j = 0; j < measures.length; j++) {
+    var values = importance[measures[j][0]];
+    importance_max[measures[j][0]] = 0.0001;
+    for (var prop in values) {
+      if (values[prop] > importance_max[measures[j][0]]) { importance_max[measures[j][0]] = values[prop]; }
+    }
+    header.append($('<th>').text(measures[j][1]));
+  }
   var weights = [];
   var val_max = 0;
   var bar_width = 200;
@@ -583,6 +613,14 @@ aic.create_weight_table = function(data) {
     var rect = $('<div>') //.css('position', 'absolute').css('left', '0px').css('top', '0px')
     .css('width', w).css('height', '10px').attr('title', loading)
     .css('background', 'navy').appendTo(bar);
+    for (var j = 0; j < measures.length; j++) {
+      var value = importance[measures[j][0]][weights[i][0]] || 0;
+      var iw = parseInt(bar_width * 0.5 * Math.max(0, value) / importance_max[measures[j][0]] * 100) * 0.01;
+      var ibar = $('<div>').width(bar_width * 0.5).css('height', bh).css('position', 'relative');
+      $('<td>').append(ibar).appendTo(tr);
+      $('<div>').css('width', iw).css('height', '10px').attr('title', value.toFixed(4))
+      .css('background', measures[j][2]).appendTo(ibar);
+    }
   }
   return table;
 };
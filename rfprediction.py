@@ -1,13 +1,15 @@
 #coding:utf-8
-import argparse, os, sys, re, math, collections, tempfile
-import sklearn, sklearn.ensemble, sklearn.metrics, numpy
+import argparse, os, sys, re, math, collections, tempfile, operator
+import numpy
 import json, copy
-import openpyxl, xlrd
+# sklearn is imported by functions of training, openpyxl and xlrd by the loader of Excel files
+# so that prediction with saved models starts quickly
 
 KEYWORD_OUTPUT = '__output__'
 KEYWORD_ID = '__id__'
 KEYWORDS_NON_NUMERIC = set([KEYWORD_OUTPUT, KEYWORD_ID])
 MARKER_COLORS = ((255,100,100), (100,255,100), (100,100,255), (224,192,0), (128,0,192), (90,224,192))
+TREE_LEAF = -1 # sklearn.tree._tree.TREE_LEAF
 
 # Python3 support
 try:
@@ -15,82 +17,222 @@ try:
 except NameError:
     basestring = str
 
-def load_table(filename, id_field=None, output_field=None):
-    """Load Excel or CSV file """
+class rfprofiler(object):
+    """Wall time, CPU time and peak memory of stages of a run.
+    Stages may be nested, each stage is recorded as a dict of
+    stage, depth (nesting level), wall and cpu (seconds), max_rss (peak RSS of the process until the end of the stage, bytes),
+    traced_peak (peak of memory traced by tracemalloc in the stage, bytes, only if trace_memory is True)
+    and stats (cProfile output of outermost stages).
+    tracemalloc slows down stages several times, so wall and cpu are not comparable with runs without trace_memory.
+    """
+    def __init__(self, stats_dir=None, trace_memory=False):
+        import tracemalloc
+        self.stages = []
+        self.stats_dir = stats_dir
+        self.__stack = []
+        self.__trace_memory = trace_memory and not tracemalloc.is_tracing()
+        if self.__trace_memory:
+            tracemalloc.start()
+        if stats_dir is not None and not os.path.exists(stats_dir):
+            os.makedirs(stats_dir)
+    def close(self):
+        import tracemalloc
+        if self.__trace_memory:
+            tracemalloc.stop()
+            self.__trace_memory = False
+    def detach(self):
+        """Stop tracing and cProfile inherited by a forked process"""
+        for record, peak, profile, wall, cpu in self.__stack:
+            if profile is not None:
+                profile.disable()
+        self.__stack = []
+        self.close()
+    @classmethod
+    def get_max_rss(cls):
+        try:
+            import resource
+        except ImportError: # Windows
+            return None
+        rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return rss if sys.platform == 'darwin' else rss * 1024
+    def start(self, name):
+        import time, tracemalloc
+        record = {'stage':name, 'depth':len(self.__stack)}
+        if self.__trace_memory:
+            if len(self.__stack) > 0: # keep peak of the outer stage
+                self.__stack[-1][1] = max(self.__stack[-1][1], tracemalloc.get_traced_memory()[1])
+            tracemalloc.reset_peak()
+        profile = None
+        if self.stats_dir is not None and len(self.__stack) == 0:
+            import cProfile
+            profile = cProfile.Profile()
+            profile.enable()
+        self.stages.append(record)
+        self.__stack.append([record, 0, profile, time.time(), time.process_time()])
+    def stop(self):
+        import time, tracemalloc
+        record, peak, profile, wall, cpu = self.__stack.pop()
+        record['wall'] = time.time() - wall
+        record['cpu'] = time.process_time() - cpu
+        if profile is not None:
+            profile.disable()
+            filename = os.path.join(self.stats_dir, '{:02d}_{}.prof'.format(len(self.stages) - 1, re.sub('\\W+', '_', record['stage'])))
+            profile.dump_stats(filename)
+            record['stats'] = filename
+        record['max_rss'] = rfprofiler.get_max_rss()
+        if self.__trace_memory:
+            peak = max(peak, tracemalloc.get_traced_memory()[1])
+            record['traced_peak'] = peak
+            if len(self.__stack) > 0:
+                self.__stack[-1][1] = max(self.__stack[-1][1], peak)
+        return record
+    def write(self, ostr=sys.stderr):
+        ostr.write('stage\twall\tcpu\tmax_rss(MB)\ttraced_peak(MB)\n')
+        for record in self.stages:
+            ostr.write('{}{}\t{:.3f}\t{:.3f}\t{}\t{}\n'.format('  ' * record['depth'], record['stage'], record.get('wall', 0), record.get('cpu', 0),
+                '-' if record.get('max_rss', None) is None else '{:.1f}'.format(record['max_rss'] / 1048576.0),
+                '-' if record.get('traced_peak', None) is None else '{:.1f}'.format(record['traced_peak'] / 1048576.0)))
+
+_profiler = None # rfprofiler of the current run if --profile is given
+
+def _detach_profiler():
+    """Stop profiling in child processes such as workers of multiprocessing"""
+    global _profiler
+    if _profiler is not None:
+        _profiler.detach()
+        _profiler = None
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_detach_profiler)
+
+class _profile_stage(object):
+    """Record a stage in _profiler if profiling is enabled
+    with _profile_stage('load'):
+        ...
+    """
+    def __init__(self, name):
+        self.name = name
+        self.profiler = _profiler
+    def __enter__(self):
+        if self.profiler is not None:
+            self.profiler.start(self.name)
+        return self
+    def __exit__(self, *args):
+        if self.profiler is not None:
+            self.profiler.stop()
+        return False
+
+LOADING_CHUNK_SIZE = 8192
+
+def __convert_to_float(item):
+    """Convert a cell into float, missing values are NaN"""
+    if item is None:
+        return numpy.nan
+    if isinstance(item, basestring):
+        item = item.strip()
+        if len(item) == 0:
+            return numpy.nan
+    return float(item)
+
+def __convert_column(values):
+    """Convert cells of a column into float64 array, negative values are regarded as missing"""
+    if '' in values: # empty cells
+        values = [(x_ if x_ != '' else None) for x_ in values]
+    try:
+        column = numpy.array(values, dtype=numpy.float64)
+    except (ValueError, TypeError):
+        column = numpy.array([__convert_to_float(x_) for x_ in values], dtype=numpy.float64)
+    column[column < 0] = numpy.nan
+    return column
+
+def __iterate_text_rows(filename, ext):
+    """Iterate rows of CSV or tab-deliminated text file"""
+    if ext in ('txt', 'tsv'): # tab-deliminated plain text
+        with open(filename) as fi:
+            for line in fi:
+                yield line.strip().split('\t')
+    else:
+        import csv
+        with open(filename) as fi:
+            for row in csv.reader(fi):
+                if len(row) > 1:
+                    yield row
+
+def __iterate_xlsx_rows(book):
+    """Iterate values of rows in the active sheet of a workbook opened in read-only mode"""
+    try:
+        for row in book.active.iter_rows(values_only=True):
+            if len(row) > 1:
+                yield row
+    finally:
+        book.close()
+
+def __iterate_xls_rows(book):
+    """Iterate values of rows in the first sheet of a workbook opened on demand"""
+    try:
+        sheet = book.sheet_by_index(0)
+        for rn in range(sheet.nrows):
+            yield sheet.row_values(rn)
+    finally:
+        book.release_resources()
+
+def __fix_cell(val):
+    """Convert integral float values of Excel cells into int"""
+    if isinstance(val, float) and abs(val - round(val)) < 1e-5:
+        return int(round(val))
+    return val
+
+def iterate_table_chunks(filename, id_field=None, output_field=None, chunk_size=LOADING_CHUNK_SIZE, fields=None):
+    """Parse a table into chunks of numeric matrix.
+    @Parameters:
+        fields : names of fields to be loaded, other columns are skipped just after tokenizing rows.
+                 Rows are accepted if more than a half of these fields are available.
+    @Return:
+        (names of numeric fields in column order, generator of chunks)
+        Each chunk is (IDs, outputs, float64 matrix [rows x fields]) of accepted rows and
+        array of the numbers of available values for each field including rejected rows.
+        Negative and empty values are NaN.
+    """
     rpos = filename.rfind('.')
     if rpos < 0:
         ext = 'csv'
     else:
         ext = filename[rpos + 1:].lower()
-    # CSV
-    table = None
+    rows = None
 
     if ext == 'xlsx':
         import openpyxl
-        table = []
-        book = openpyxl.reader.excel.load_workbook(filename)
-        sheet = book.get_active_sheet()
-        for row in sheet.rows:
-            if len(row) > 1:
-                table.append([x_.value for x_ in row])
+        book = openpyxl.load_workbook(filename, read_only=True, data_only=True)
+        rows = __iterate_xlsx_rows(book)
     elif ext == 'xls':
         try:
-            table = []
             import xlrd
-            book = xlrd.open_workbook(filename)
-            sheet = book.sheets()[0]#[0]
-            for rn in range(sheet.nrows):
-                row = sheet.row(rn)
-                values = [row[c].value for c in range(sheet.ncols)]
-                table.append(values)
+            book = xlrd.open_workbook(filename, on_demand=True)
+            rows = __iterate_xls_rows(book)
         except:
-            table = None
+            rows = None
             pass
-    elif ext == 'txt': # tab-deliminated plain text
-        table = []
-        with open(filename) as fi:
-            #items = fi.readline().strip().split('\t')
-            string_columns = []
-            for line in fi:
-                items = []
-                for item in line.strip().split('\t'):
-                    # if re.match('\\-?\\d*\\.?\\d+$', item):
-                    #     items.append(float(item))
-                    # else:
-                    items.append(item)
-                table.append(items)
-    if table is None: # CSV
-        import csv
-        table = []
-        with open(filename) as fi:
-            reader = csv.reader(fi)
-            for row in reader:
-                if len(row) > 1:
-                    table.append(row)
-    # fix integer values
-    for rn, row in enumerate(table):
-        for cn, val in enumerate(row):
-            if isinstance(val, float):
-                if (val - round(val)) < 1e-5:
-                    row[cn] = int(val)
+    if rows is None: # CSV or TSV
+        rows = __iterate_text_rows(filename, ext)
 
     # determine fields
-    header_row = -1
-    for rn in range(len(table)):
+    header = None
+    for row in rows:
+        row = [__fix_cell(x_) for x_ in row]
         num = 0
-        for cn, item in enumerate(table[rn]):
+        for cn, item in enumerate(row):
             if item is not None:
                 if isinstance(item, basestring) and len(item) > 0:
                     num += 1
                 elif isinstance(item, int):
                     num += 1
         if num > 3:
-            header_row = rn
+            header = row
             break
-    if header_row < 0:
+    if header is None:
         raise Exception('no field row found')
-    header = [(item if isinstance(item, basestring) else repr(item)) for item in table[header_row]]
-    props = {}
+    header = [(item if isinstance(item, basestring) else repr(item)) for item in header]
+    props = collections.OrderedDict()
     index_output = -1
     index_id = -1
     for i, val in enumerate(header):
@@ -99,161 +241,501 @@ def load_table(filename, id_field=None, output_field=None):
         elif val == id_field and index_id < 0:
             index_id = i
         else:
-            #val = repr(val)
-            if val is not None and len(val) > 0 and val not in props:# and val != 'ID_REF' and val.lower() != 'id':
+            if val is not None and len(val) > 0 and val not in props:
                 props[val] = i
     if index_output < 0:
         raise Exception('No index field {} in {}'.format(id_field, filename))
-
-    data = []
-
-    available_properties = {}
-    for p in props.keys(): available_properties[p] = 0
-    rownum = 0
-    for row in table[header_row + 1:]:
-        datum = {}
-        num_accepted = 0
-        datum[KEYWORD_OUTPUT] = row[index_output]
-        if index_id < 0:
-            datum[KEYWORD_ID] = 'ID:{}'.format(rownum)
-        elif not isinstance(row[index_id], basestring):
-            datum[KEYWORD_ID] = repr(row[index_id])
-        else:
-            datum[KEYWORD_ID] = row[index_id]
-        #print(props)
-        for pr, col in props.items():
-            item = row[col]
-            if item is None:
-                datum[pr] = None
-                continue
-#            if item is None: # missing data
-#
-            #print(col, item, item.__class__)
+    if fields is not None:
+        fields = set(fields)
+        props = collections.OrderedDict([(k_, v_) for k_, v_ in props.items() if k_ in fields])
+    names = list(props.keys())
+    columns = list(props.values())
+    width = max([index_output, index_id] + columns) + 1
+    # cells of rows are projected into [output, ID, fields...]
+    selected = [index_output] + ([index_id] if index_id >= 0 else []) + columns
+    offset = 2 if index_id >= 0 else 1
+    if len(selected) > 1:
+        project = operator.itemgetter(*selected)
+    else:
+        project = lambda r_:(r_[index_output],)
+
+    def iterate_chunks():
+        import itertools
+        rownum = 0
+        while 1:
+            block = list(itertools.islice(rows, chunk_size))
+            if len(block) == 0: break
+            if any(len(r_) < width for r_ in block):
+                block = [(r_ if len(r_) >= width else list(r_) + [None] * (width - len(r_))) for r_ in block]
+            cells = list(zip(*[project(r_) for r_ in block]))
+            matrix = numpy.empty((len(block), len(columns)), dtype=numpy.float64)
+            for j in range(len(columns)):
+                matrix[:, j] = __convert_column(cells[offset + j])
+            valid = ~numpy.isnan(matrix)
+            available = valid.sum(axis=0)
+            accepted = numpy.nonzero(valid.sum(axis=1) > len(columns) // 2)[0]
+            outputs = [__fix_cell(cells[0][i]) for i in accepted]
+            if index_id < 0:
+                ids = ['ID:{}'.format(rownum + i) for i in range(accepted.shape[0])]
+            else:
+                ids = [(x_ if isinstance(x_, basestring) else repr(__fix_cell(x_))) for x_ in [cells[1][i] for i in accepted]]
+            rownum += accepted.shape[0]
+            yield ids, outputs, matrix[accepted], available
+    return names, iterate_chunks()
+
+def load_table_columns(filename, id_field=None, output_field=None, chunk_size=LOADING_CHUNK_SIZE, fields=None):
+    """Load Excel, CSV or tab-deliminated file into columns.
+    Rows are parsed in chunks into a growing float64 buffer, and fields available
+    in less than a half of rows are removed. Only given fields are loaded if fields is set.
+    @Return:
+        (fields, float64 matrix [rows x fields] having NaN as missing values, IDs, outputs, numbers of missing values of fields)
+    """
+    names, chunks = iterate_table_chunks(filename, id_field, output_field, chunk_size, fields)
+    buffer = numpy.empty((0, len(names)), dtype=numpy.float64)
+    num_rows = 0
+    ids = []
+    outputs = []
+    available = numpy.zeros(len(names), dtype=numpy.int64)
+    missing = numpy.zeros(len(names), dtype=numpy.int64)
+    for ids_, outputs_, matrix, available_ in chunks:
+        available += available_
+        missing += numpy.isnan(matrix).sum(axis=0)
+        if num_rows + matrix.shape[0] > buffer.shape[0]: # reallocation keeps data in place if possible
+            buffer.resize((max(num_rows + matrix.shape[0], buffer.shape[0] * 2), len(names)), refcheck=False)
+        buffer[num_rows:num_rows + matrix.shape[0]] = matrix
+        num_rows += matrix.shape[0]
+        ids += ids_
+        outputs += outputs_
+    buffer.resize((num_rows, len(names)), refcheck=False)
+    minimum = num_rows // 2
+    accepted = available >= minimum
+    if not accepted.all():
+        buffer = buffer[:, accepted]
+        missing = missing[accepted]
+        names = [n_ for n_, a_ in zip(names, accepted) if a_]
+    return names, buffer, ids, outputs, missing
+
+def load_table(filename, id_field=None, output_field=None, fields=None):
+    """Load Excel or CSV file, only given fields are loaded if fields is set"""
+    return rfdataset.from_table(filename, id_field, output_field, fields).to_records()
+
+class rfdataset(object):
+    """Columnar data set of samples.
+
+    matrix : float64 array [samples x fields], NaN for missing values
+    fields : names of columns of matrix
+    field_index : dict of field name to column index
+    ids : IDs of samples
+    outputs : output values (group names) of samples
+    medians : values put in missing data by complete_missing_values
+    column_medians : medians of available values of columns, given by get_column_medians
+    """
+    def __init__(self, fields, matrix, ids, outputs):
+        self.matrix = numpy.asarray(matrix, dtype=numpy.float64).reshape(len(ids), len(fields))
+        self.fields = list(fields)
+        self.field_index = dict([(f_, i) for i, f_ in enumerate(self.fields)])
+        self.ids = list(ids)
+        self.outputs = list(outputs)
+        self.medians = None
+        self.column_medians = None
+    def __len__(self):
+        return len(self.ids)
+    @classmethod
+    def from_table(cls, filename, id_field=None, output_field=None, fields=None):
+        """Load Excel, CSV or tab-deliminated file, only given fields are loaded if fields is set"""
+        fields, matrix, ids, outputs, missing = load_table_columns(filename, id_field, output_field, fields=fields)
+        return rfdataset(fields, matrix, ids, outputs)
+    @classmethod
+    def from_records(cls, data):
+        """Convert list of dict objects given by load_table"""
+        if isinstance(data, rfdataset):
+            return data
+        fields = [f_ for f_ in data[0].keys() if f_ not in KEYWORDS_NON_NUMERIC] if len(data) > 0 else []
+        matrix = numpy.array([[datum.get(f_, None) for f_ in fields] for datum in data], dtype=numpy.float64)
+        ids = [datum.get(KEYWORD_ID, None) for datum in data]
+        outputs = [datum.get(KEYWORD_OUTPUT, None) for datum in data]
+        return rfdataset(fields, matrix, ids, outputs)
+    def arrange(self, fields):
+        """Reorder columns to put given fields first so that get_matrix(fields) returns a view"""
+        order = [self.field_index[f_] for f_ in fields if f_ in self.field_index]
+        if order == list(range(len(order))):
+            return self
+        chosen = set(order)
+        order += [i for i in range(len(self.fields)) if i not in chosen]
+        self.matrix = self.matrix[:, order]
+        if self.column_medians is not None:
+            self.column_medians = self.column_medians[order]
+        self.fields = [self.fields[i] for i in order]
+        self.field_index = dict([(f_, i) for i, f_ in enumerate(self.fields)])
+        return self
+    def get_matrix(self, fields=None):
+        """Return matrix [samples x fields], columns of unknown fields are NaN.
+        The matrix is not copied if fields are leading columns."""
+        if fields is None or list(fields) == self.fields[0:len(fields)]:
+            return self.matrix[:, 0:len(self.fields) if fields is None else len(fields)]
+        matrix = numpy.full((len(self.ids), len(fields)), numpy.nan, dtype=numpy.float64)
+        for j, f_ in enumerate(fields):
+            if f_ in self.field_index:
+                matrix[:, j] = self.matrix[:, self.field_index[f_]]
+        return matrix
+    def normalize_outputs(self):
+        """Convert non-string outputs into strings, returns (output groups in order of appearance, label indices)"""
+        l2n = {}
+        groups = []
+        labels = numpy.empty(len(self.outputs), dtype=numpy.intp)
+        for i, label in enumerate(self.outputs):
+            if not isinstance(label, basestring):
+                label = repr(label)
+                self.outputs[i] = label
+            if label not in l2n:
+                l2n[label] = len(l2n)
+                groups.append(label)
+            labels[i] = l2n[label]
+        return groups, labels
+    def get_labels(self, output_groups):
+        """Return array of indices of output groups, -1 for unknown outputs"""
+        l2n = {}
+        for i, l in enumerate(output_groups):
+            if l not in l2n: l2n[l] = i
+        return numpy.array([l2n.get(x_, -1) for x_ in self.outputs], dtype=numpy.intp)
+    def get_column_medians(self):
+        """Return medians of available values of columns, NaN for columns having no value"""
+        if self.column_medians is None:
+            import warnings
+            with warnings.catch_warnings():
+                warnings.simplefilter('ignore', RuntimeWarning) # all-NaN columns
+                self.column_medians = numpy.nanmedian(self.matrix, axis=0) if len(self.ids) > 0 else numpy.full(len(self.fields), numpy.nan)
+        return self.column_medians
+    def complete_missing_values(self, medians=None):
+        """Put median values in missing data
+        @Parameters:
+            medians : dict of field name to value used instead of the median of this data set,
+                      e.g. medians of training set
+        @Return:
+            dict of field name to value put in each field
+        """
+        missing = numpy.isnan(self.matrix)
+        values = numpy.empty(len(self.fields), dtype=numpy.float64)
+        required = []
+        for j, field in enumerate(self.fields):
+            if medians is not None and field in medians:
+                values[j] = medians[field]
+            else:
+                required.append(j)
+        if len(required) > 0:
+            values[required] = self.get_column_medians()[required]
+            unavailable = numpy.isnan(values[required])
+            if unavailable.any():
+                raise Exception('no data in {}th column'.format(required[numpy.nonzero(unavailable)[0][0]]))
+        numpy.copyto(self.matrix, values[numpy.newaxis, :], where=missing)
+        self.medians = dict(zip(self.fields, values.tolist()))
+        return self.medians
+    def iterate_records(self, fields=None, start=0, end=None, chunk_size=LOADING_CHUNK_SIZE):
+        """Generate dict objects of samples as load_table, missing values are None"""
+        if fields is None:
+            fields = self.fields
+        if end is None:
+            end = len(self.ids)
+        for offset in range(start, end, chunk_size):
+            stop = min(end, offset + chunk_size)
+            matrix = self.get_matrix(fields)[offset:stop].tolist()
+            for i, values in enumerate(matrix):
+                datum = {KEYWORD_OUTPUT:self.outputs[offset + i], KEYWORD_ID:self.ids[offset + i]}
+                for field, val in zip(fields, values):
+                    datum[field] = val if val == val else None
+                yield datum
+    def to_records(self, fields=None):
+        """Convert into list of dict objects as load_table, missing values are None"""
+        return list(self.iterate_records(fields))
+
+class rfrecords(object):
+    """Read-only sequence of dict objects of samples made on demand from rfdataset.
+    It is put in results instead of list given by to_records not to keep all records in memory.
+    """
+    def __init__(self, dataset, fields=None):
+        self.dataset = dataset
+        self.fields = list(dataset.fields if fields is None else fields)
+    def __len__(self):
+        return len(self.dataset)
+    def __iter__(self):
+        return self.dataset.iterate_records(self.fields)
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(len(self)))]
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError('record index out of range')
+        return next(self.dataset.iterate_records(self.fields, index, index + 1))
+
+def complete_missing_values(data, medians=None):
+    """Put median values in missing data
+    @Return:
+        dict of field name to value put in each field
+    """
+    if isinstance(data, rfdataset):
+        return data.complete_missing_values(medians)
+    dataset = rfdataset.from_records(data)
+    rows, columns = numpy.nonzero(numpy.isnan(dataset.matrix))
+    used = dataset.complete_missing_values(medians)
+    for i, j in zip(rows.tolist(), columns.tolist()):
+        data[i][dataset.fields[j]] = float(dataset.matrix[i, j])
+    return used
+
+TABLE_CACHE_VERSION = 1
+_table_cache_dir = None
+_table_cache_size = 1 << 30
+
+def __get_table_cache_key(filename, id_field, output_field, fields):
+    """Hash of file contents and loading parameters"""
+    import hashlib
+    digest = hashlib.sha256()
+    with open(filename, 'rb') as fi:
+        while 1:
+            block = fi.read(1 << 20)
+            if not block: break
+            digest.update(block)
+    rpos = filename.rfind('.')
+    params = [TABLE_CACHE_VERSION, filename[rpos + 1:].lower() if rpos >= 0 else 'csv', id_field, output_field, fields]
+    digest.update(json.dumps(params).encode('utf-8'))
+    return digest.hexdigest()
+
+def __evict_table_cache(directory, limit):
+    """Remove least recently used files until total size is under limit.
+    Files owned by the cache, parsed tables (.npz), scores of parameter search (search_*.json)
+    and sources of compiled forests (forest_*.py), are counted.
+    """
+    entries = []
+    for name in os.listdir(directory):
+        if name.endswith('.npz') or re.match(r'^(search_[0-9a-f]+\.json|forest_[0-9a-f]+\.py)$', name):
+            path = os.path.join(directory, name)
             try:
-                val = float(item)
-                if val < 0:
-                    val = None
-                else:
-                    available_properties[pr] += 1
-                    num_accepted += 1
-            except:
-                val = None
-                raise
-            datum[pr] = val
-        if num_accepted > len(props) // 2:
-            data.append(datum)
-            rownum += 1
-    minimum = len(data) // 2
-    removing = set([p for p in props.keys() if available_properties[p] < minimum])
-    for datum in data:
-        for pr in removing:
-            datum.pop(pr)
-    return data
-
-def complete_missing_values(data):
-    """Put median values in missing data """
-    N = len(data)
-    M = len(data[0])#.dimensions
-    for field in data[0].keys():
-        if field in KEYWORDS_NON_NUMERIC: continue
-        values = []
-        for j, datum in enumerate(data):
-            values.append(datum[field])
-#            values.append(datum[i])#.get_value(i))
-        if None not in values:
-            continue
-        sval = sorted([x_ for x_ in values if x_ is not None])
-        K = len(sval)
-        if K == 0:
-            raise Exception('no data in {}th column'.format(i))
-        if K % 2 == 0:
-            median = .5 * (sval[K // 2] + sval[K // 2 + 1])
-        else:
-            median = sval[K // 2]
-        for datum in data:
-            if datum[field] is None:
-                datum[field] = median
+                st = os.stat(path)
+            except OSError: # removed by other process
+                continue
+            entries.append((st.st_mtime, st.st_size, path))
+    total = sum([e_[1] for e_ in entries])
+    for mtime, size, path in sorted(entries):
+        if total <= limit: break
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+        total -= size
 
-def generate_classifier(data, fields=None, max_depth=4, num_trees=20):
+def load_dataset(filename, id_field=None, output_field=None, fields=None):
+    """Load a table as rfdataset having column medians.
+    If _table_cache_dir is set, parsed tables are kept in the directory as .npz files keyed by
+    SHA-256 of the file contents and parameters. Total size of the files is kept under
+    _table_cache_size bytes by removing least recently used ones.
+    """
+    if _table_cache_dir is None:
+        dataset = rfdataset.from_table(filename, id_field, output_field, fields)
+        dataset.get_column_medians()
+        return dataset
+    key = __get_table_cache_key(filename, id_field, output_field, None if fields is None else sorted(fields))
+    filename_cache = os.path.join(_table_cache_dir, key + '.npz')
+    if os.path.exists(filename_cache):
+        try:
+            with numpy.load(filename_cache, allow_pickle=False) as cached:
+                meta = json.loads(cached['meta'].tobytes().decode('utf-8'))
+                dataset = rfdataset(meta['fields'], cached['matrix'], meta['ids'], meta['outputs'])
+                dataset.column_medians = cached['medians']
+            os.utime(filename_cache, None) # recently used
+            return dataset
+        except Exception as e: # broken or removed file
+            sys.stderr.write('failed to load cache of {} : {}\n'.format(filename, repr(e)))
+    dataset = rfdataset.from_table(filename, id_field, output_field, fields)
+    medians = dataset.get_column_medians()
+    if os.path.exists(_table_cache_dir) is False:
+        os.makedirs(_table_cache_dir)
+    meta = json.dumps({'fields':dataset.fields, 'ids':dataset.ids, 'outputs':dataset.outputs, 'filename':filename})
+    fd, filename_tmp = tempfile.mkstemp('.tmp', key, _table_cache_dir)
+    try:
+        with os.fdopen(fd, 'wb') as fo:
+            numpy.savez(fo, matrix=dataset.matrix, medians=medians, meta=numpy.frombuffer(meta.encode('utf-8'), dtype=numpy.uint8))
+        os.replace(filename_tmp, filename_cache) # atomic for concurrent workers
+    finally:
+        if os.path.exists(filename_tmp):
+            os.remove(filename_tmp)
+    __evict_table_cache(_table_cache_dir, _table_cache_size)
+    return dataset
+
+def generate_classifier(data, fields=None, max_depth=4, num_trees=20, random_state=None, max_features='sqrt'):
     """Generate random forest
     returns [Classifier object, applied fields, output groups]
+    Parameters are selected by search_parameters if max_depth or num_trees is a list.
 
     output_groups = [group_name_1, group_name_2, ...]
     """
 
-    vectors = []
-    labels = []
+    data = rfdataset.from_records(data)
     if fields is None:
-        fields = sorted([x_ for x_ in data[0].keys() if x_ not in KEYWORDS_NON_NUMERIC])
+        fields = sorted(data.fields)
 #    else:
 #        fields = sorted([x_ for x_ in fields if x_ not in KEYWORDS_NON_NUMERIC])
-    l2n = {}
-    output_groups = []
-    for datum in data:
-        label = datum[KEYWORD_OUTPUT]
-        if not isinstance(label, basestring):
-            label = repr(label)
-            datum[KEYWORD_OUTPUT] = label
-        if label not in l2n:
-            l2n[label] = len(l2n)
-            output_groups.append(label)
-        labels.append(l2n[label])
-        vector = [datum[x_] for x_ in fields]
-        vectors.append(vector)
+    output_groups, labels = data.normalize_outputs()
+    vectors = data.get_matrix(fields)
     if max_depth is None:
-        max_depth = (3,4,5,7,10,15)
+        max_depth = SEARCH_DEPTHS
     if num_trees is None:
-        max_trees = [5,10,20,30,50]
+        num_trees = SEARCH_TREES
 
     if isinstance(max_depth, (list, tuple)) or isinstance(num_trees, (list, tuple)):
         # Grid search
-        import sklearn.model_selection, sklearn.ensemble
-        parameters = {'n_estimators':num_trees,
-                      #'max_features':fields,
-                      'max_depth':max_depth,
-                      #'min_sample_split':[10,20,50,80,90],
-                      'max_features':[x_ for x_ in range(2, len(fields))],
-                      'verbose':[int(verbose), ],
-                      #'n_jobs':[4,],
-                      }
-        clf = sklearn.model_selection.GridSearchCV(sklearn.ensemble.RandomForestClassifier(), parameters)
-        clf.fit(vectors, labels)
-        # for key, val in clf.get_params().items():
-        #     print(key, val)
-        # print(clf.best_estimator_)
-        rf = clf.best_estimator_
-    else:
-        # preset parameter
-        rf = sklearn.ensemble.RandomForestClassifier(max_depth=max_depth, n_estimators=num_trees)
-        rf.fit(vectors, labels)
+        best, table = search_parameters(vectors, labels, num_trees, max_depth, get_max_features_candidates(len(fields)), seed=random_state)
+        num_trees, max_depth, max_features = best['num_trees'], best['depth'], best['max_features']
+    # preset parameter
+    import sklearn.ensemble
+    rf = sklearn.ensemble.RandomForestClassifier(max_depth=max_depth, n_estimators=num_trees, random_state=random_state, max_features=max_features)
+    rf.fit(vectors, labels)
 #    raise Exception('interrupted')
 #    exit()
     return rf, fields, output_groups
 
+SEARCH_FOLDS = 5
+SEARCH_FACTOR = 3
+SEARCH_DEPTHS = (3,4,5,7,10,15)
+SEARCH_TREES = (5,10,20,30,50)
+_search_cache = {}
+_search_context = {}
+
+def get_max_features_candidates(num_fields):
+    """Numbers of features examined at each split in search_parameters"""
+    candidates = list(range(2, num_fields))
+    if len(candidates) == 0:
+        candidates = ['sqrt']
+    return candidates
+
+def _evaluate_candidate(matrix, labels, folds, num_trees, max_depth, max_features, fold, seed):
+    """Accuracy of a forest trained without the fold and tested with the fold"""
+    training, test = folds[fold]
+    import sklearn.ensemble, sklearn.metrics
+    rf = sklearn.ensemble.RandomForestClassifier(n_estimators=num_trees, max_depth=max_depth, max_features=max_features, random_state=seed)
+    rf.fit(matrix[training], labels[training])
+    return float(sklearn.metrics.accuracy_score(labels[test], rf.predict(matrix[test])))
+
+def _initialize_search_worker(matrix, labels, folds):
+    _search_context['matrix'] = matrix
+    _search_context['labels'] = labels
+    _search_context['folds'] = folds
+
+def _evaluate_candidate_in_worker(params):
+    return _evaluate_candidate(_search_context['matrix'], _search_context['labels'], _search_context['folds'], *params)
+
+def __get_search_cache_filename(matrix, labels, num_folds, seed):
+    """Scores are kept in a JSON file in _table_cache_dir named by hash of data and fold splits"""
+    if _table_cache_dir is None:
+        return None
+    import hashlib
+    digest = hashlib.sha256()
+    digest.update(numpy.ascontiguousarray(matrix).tobytes())
+    digest.update(numpy.ascontiguousarray(labels, dtype=numpy.int64).tobytes())
+    digest.update(json.dumps([matrix.shape, num_folds, seed]).encode('utf-8'))
+    return os.path.join(_table_cache_dir, 'search_{}.json'.format(digest.hexdigest()))
+
+def search_parameters(matrix, labels, num_trees, max_depth, max_features, num_jobs=1, seed=None, num_folds=SEARCH_FOLDS, factor=SEARCH_FACTOR, verbose=False):
+    """Select parameters of random forest by successive halving over cross validation folds.
+    All candidates are evaluated with the first fold, and 1/factor of them having the best mean scores
+    are evaluated with the next fold until all folds are used.
+    Scores of (candidate, fold) are cached in memory and in _table_cache_dir if it is set,
+    extending the grid later evaluates only new candidates.
+    @Parameters:
+        matrix, labels : training data
+        num_trees, max_depth, max_features : candidate values (int or list)
+        num_jobs : number of processes
+        seed : random state of fold splits and forests
+    @Return:
+        (best parameters, table of scores)
+        parameters are dict having num_trees, depth, max_features, scores (list of fold scores, None for pruned folds) and mean
+    """
+    def as_list(values):
+        return list(values) if isinstance(values, (list, tuple)) else [values]
+    matrix = numpy.asarray(matrix, dtype=numpy.float64)
+    labels = numpy.asarray(labels, dtype=numpy.intp)
+    candidates = []
+    for n in as_list(num_trees):
+        for d in as_list(max_depth):
+            for f in as_list(max_features):
+                candidates.append((n, d, f))
+    counts = numpy.bincount(labels)
+    num_folds = max(2, min(num_folds, int(counts[counts > 0].min()) if counts.size > 0 else 2, labels.shape[0]))
+    import sklearn.model_selection
+    splitter = sklearn.model_selection.StratifiedKFold(n_splits=num_folds, shuffle=True, random_state=seed)
+    folds = list(splitter.split(matrix, labels))
+
+    filename_cache = __get_search_cache_filename(matrix, labels, num_folds, seed)
+    if seed is None: # folds are not reproducible
+        filename_cache = None
+        _search_cache.pop(None, None)
+    if filename_cache not in _search_cache:
+        _search_cache[filename_cache] = {}
+        if filename_cache is not None and os.path.exists(filename_cache):
+            try:
+                with open(filename_cache) as fi:
+                    _search_cache[filename_cache] = json.load(fi)
+            except Exception as e:
+                sys.stderr.write('failed to load {} : {}\n'.format(filename_cache, repr(e)))
+    cache = _search_cache[filename_cache]
+    def get_key(candidate):
+        return json.dumps(list(candidate))
+
+    pool = None
+    if num_jobs > 1:
+        import multiprocessing
+        pool = multiprocessing.Pool(num_jobs, _initialize_search_worker, (matrix, labels, folds))
+    try:
+        survivors = list(candidates)
+        for fold in range(num_folds):
+            tasks = [c_ for c_ in survivors if str(fold) not in cache.get(get_key(c_), {})]
+            params = [c_ + (fold, seed) for c_ in tasks]
+            if pool is not None:
+                scores = pool.map(_evaluate_candidate_in_worker, params)
+            else:
+                scores = [_evaluate_candidate(matrix, labels, folds, *p_) for p_ in params]
+            for c_, score in zip(tasks, scores):
+                cache.setdefault(get_key(c_), {})[str(fold)] = score
+            if verbose:
+                sys.stderr.write('fold {}/{}\t{} candidates\t{} trained\n'.format(fold + 1, num_folds, len(survivors), len(tasks)))
+            if fold < num_folds - 1:
+                means = [numpy.mean([cache[get_key(c_)][str(f_)] for f_ in range(fold + 1)]) for c_ in survivors]
+                order = sorted(range(len(survivors)), key=lambda i:-means[i]) # stable for ties
+                survivors = [survivors[i] for i in order[0:max(1, -(-len(survivors) // factor))]]
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+    if filename_cache is not None:
+        if os.path.exists(_table_cache_dir) is False:
+            os.makedirs(_table_cache_dir)
+        fd, filename_tmp = tempfile.mkstemp('.tmp', 'search', _table_cache_dir)
+        with os.fdopen(fd, 'w') as fo:
+            json.dump(cache, fo)
+        os.replace(filename_tmp, filename_cache)
+        __evict_table_cache(_table_cache_dir, _table_cache_size)
+
+    table = []
+    for c_ in candidates:
+        scores = [cache.get(get_key(c_), {}).get(str(f_), None) for f_ in range(num_folds)]
+        available = [x_ for x_ in scores if x_ is not None]
+        table.append({'num_trees':c_[0], 'depth':c_[1], 'max_features':c_[2], 'scores':scores,
+            'mean':float(numpy.mean(available)) if len(available) > 0 else None})
+    completed = [t_ for t_ in table if None not in t_['scores']]
+    best = max(completed, key=lambda t_:t_['mean']) # first one for ties
+    return best, table
+
 def predict_samples(rf, data, output_groups, fields=None):
     """Returns [predicted results, accuracy score]
     If output_field is not set (unknown data), accuracy will be set None """
+    data = rfdataset.from_records(data)
     if fields is None:
-        fields = sorted([x_ for x_ in data[0].keys() if x_ not in KEYWORDS_NON_NUMERIC])
-    vectors = []
-    l2n = {}
-    for i, l in enumerate(output_groups):
-        l2n[l] = i
-    labels = []
-    for datum in data:
-        if KEYWORD_OUTPUT not in datum or datum[KEYWORD_OUTPUT] not in l2n:
-            # having samples without name
-            labels = None
-            break
-        else:
-            labels.append(l2n[datum[KEYWORD_OUTPUT]])
-    for datum in data:
-        vector = []
-        for field in fields:
-            vector.append(datum[field])
-        vectors.append(vector)
-    predicted = rf.predict(vectors)
+        fields = sorted(data.fields)
+    labels = data.get_labels(output_groups)
+    if (labels < 0).any(): # having samples without name
+        labels = None
+    predicted = rf.predict(data.get_matrix(fields))
     if labels is not None:
+        import sklearn.metrics
         accuracy = sklearn.metrics.accuracy_score(predicted, labels)
     else:
         accuracy = None
@@ -261,21 +743,14 @@ def predict_samples(rf, data, output_groups, fields=None):
 
 def display_prediction_stats(forest, data, output_groups, fields=None):
     """Prediction results """
-    vectors = []
-    labels = []
+    data = rfdataset.from_records(data)
     if fields is None:
-        fields = sorted([x_ for x_ in data[0].keys() if x_ not in KEYWORDS_NOT_NUMERIC])
-    l2n = {}
-    for ind, gr in enumerate(output_groups): l2n[gr] = ind
-    for datum in data:
-        if labels is not None and KEYWORD_OUTPUT in datum:
-            labels.append(l2n[datum[KEYWORD_OUTPUT]])
-        else:
-            labels = None
-        vectors.append([datum[f_] for f_ in fields])
-    predicted = forest.predict(vectors)
+        fields = sorted(data.fields)
+    labels = data.get_labels(output_groups)
+    predicted = forest.predict(data.get_matrix(fields))
     #print(predicted)
     #print(labels)
+    import sklearn.metrics
     accuracy = sklearn.metrics.accuracy_score(predicted, labels)
     #print(sklearn.metrics.confusion_matrix(predicted, labels))
     #print('accuracy={}'.format(accuracy))
@@ -298,7 +773,7 @@ def get_group_decision(forest, vector):
 
 def get_total_scores(tree, node_id=0):
     """Sum up weights for normalization """
-    leaf_id = sklearn.tree._tree.TREE_LEAF
+    leaf_id = TREE_LEAF
     if node_id == leaf_id:
         raise ValueError("invalid node id {}".format(node_id))
     left_child = tree.children_left[node_id]
@@ -320,7 +795,7 @@ def get_total_scores(tree, node_id=0):
 def evaluate(tree, node_id, vector):
     """Evaluate vector using random forest recursively.
     return : value """
-    leaf_id = sklearn.tree._tree.TREE_LEAF
+    leaf_id = TREE_LEAF
     if node_id == leaf_id:
         raise ValueError("invalid node id {}".format(node_id))
     left_child = tree.children_left[node_id]
@@ -340,7 +815,7 @@ def evaluate(tree, node_id, vector):
 
 def enumerate_features_in_tree(tree, node_id, counts):
     """Enumerate features used in a tree"""
-    leaf_id = sklearn.tree._tree.TREE_LEAF
+    leaf_id = TREE_LEAF
     if node_id == leaf_id:
         raise ValueError("invalid node id {}".format(node_id))
     left_child = tree.children_left[node_id]
@@ -362,7 +837,6 @@ def get_group_score(forest, vector):
     scores = None
     num = 0
     for est in forest.estimators_:
-        sample_numbers = get_total_scores(est.tree_)
         score = evaluate(est.tree_, 0, vector)
         div = 1.0 / sum(score)#sample_numbers)
         normalized = [(s * div) for s in score]
@@ -375,6 +849,101 @@ def get_group_score(forest, vector):
             num += 1
     return [(float(s) / num) for s in scores]
 
+SCORING_CHUNK_SIZE = 65536 # rows of a shard scored by a worker
+SHARED_ALIGNMENT = 64
+_scoring_context = {}
+
+def __create_shared_arrays(arrays):
+    """Copy arrays into a block of multiprocessing.shared_memory
+    @Parameters:
+        arrays : dict of name and array, None values are allocated as zeros of (shape, dtype)
+    @Return:
+        (SharedMemory, layout {name:(offset, dtype, shape)}, dict of views of the block)
+    """
+    from multiprocessing import shared_memory
+    layout = {}
+    size = 0
+    for key, array in sorted(arrays.items()):
+        dtype, shape = (array.dtype, array.shape) if isinstance(array, numpy.ndarray) else (numpy.dtype(array[1]), array[0])
+        layout[key] = (size, dtype.str, tuple(shape))
+        size += int(numpy.prod(shape)) * dtype.itemsize
+        size = (size + SHARED_ALIGNMENT - 1) // SHARED_ALIGNMENT * SHARED_ALIGNMENT
+    block = shared_memory.SharedMemory(create=True, size=max(1, size))
+    views = __get_shared_views(block, layout)
+    for key, array in arrays.items():
+        if isinstance(array, numpy.ndarray):
+            views[key][...] = array
+        else:
+            views[key][...] = 0
+    return block, layout, views
+
+def __get_shared_views(block, layout):
+    return dict([(key, numpy.ndarray(shape, dtype=numpy.dtype(dtype), buffer=block.buf, offset=offset)) for key, (offset, dtype, shape) in layout.items()])
+
+def _initialize_scoring_worker(name, layout):
+    """Attach the block of __create_shared_arrays in a worker of get_group_scores without copying it"""
+    from multiprocessing import shared_memory
+    try:
+        block = shared_memory.SharedMemory(name=name, track=False)
+    except TypeError: # track is available since Python 3.13, workers share the resource tracker of the parent
+        block = shared_memory.SharedMemory(name=name)
+    views = __get_shared_views(block, layout)
+    arrays = dict([(key[7:], views[key]) for key in views if key.startswith('forest.')])
+    _scoring_context['block'] = block
+    _scoring_context['forest'] = rfclassifier.from_arrays(arrays)
+    _scoring_context['matrix'] = views['matrix']
+    _scoring_context['scores'] = views['scores']
+
+def _score_shard_in_worker(bounds):
+    start, end = bounds
+    scores, predicted = _scoring_context['forest'].predict_scores(_scoring_context['matrix'][start:end])
+    _scoring_context['scores'][start:end] = scores
+    return start, end
+
+def get_group_scores(forest, matrix, num_jobs=1, chunk_size=SCORING_CHUNK_SIZE):
+    """Batched version of get_group_score.
+    If num_jobs > 1, flat arrays of the forest, the matrix and the scores are put into shared memory once,
+    and shards of chunk_size rows are scored by num_jobs processes writing scores at the positions of their rows.
+    @Parameters:
+        forest : RandomForestClassifier or rfclassifier
+        matrix : 2D array of samples x fields
+    @Return:
+        (array of normalized scores [samples x groups], array of predicted group indices)
+    """
+    compiled = rfclassifier.from_forest(forest)
+    matrix = numpy.asarray(matrix, dtype=numpy.float64)
+    if num_jobs <= 1 or matrix.ndim != 2 or matrix.shape[0] <= chunk_size:
+        return compiled.predict_scores(matrix)
+    import multiprocessing
+    arrays = dict([('forest.' + key, numpy.ascontiguousarray(array)) for key, array in compiled.to_arrays().items()])
+    arrays['matrix'] = matrix
+    arrays['scores'] = ((matrix.shape[0], compiled.value.shape[1]), numpy.float64)
+    block, layout, views = __create_shared_arrays(arrays)
+    try:
+        shards = [(start, min(start + chunk_size, matrix.shape[0])) for start in range(0, matrix.shape[0], chunk_size)]
+        pool = multiprocessing.Pool(min(num_jobs, len(shards)), _initialize_scoring_worker, (block.name, layout))
+        try:
+            for bounds in pool.imap_unordered(_score_shard_in_worker, shards):
+                pass
+        finally:
+            pool.close()
+            pool.join()
+        scores = views['scores'].copy()
+    finally:
+        views = None
+        block.close()
+        block.unlink()
+    return scores, numpy.argmax(scores, axis=1)
+
+def predict_by_tree(tree, matrix):
+    """Batched decision of a single tree, returns indices of groups having maximum value"""
+    compiled = tree if isinstance(tree, rfclassifier) else rfclassifier.from_trees([tree])
+    matrix = numpy.asarray(matrix, dtype=numpy.float64)
+    if matrix.ndim == 1:
+        matrix = matrix.reshape(1, -1)
+    leaves = compiled.apply(matrix)[:, 0]
+    return numpy.argmax(compiled.value[leaves], axis=1)
+
 def determine_group(tree, vector):
     """Determine group of input
     return array of weights. [1,] or [.5, .5] or something.
@@ -396,58 +965,57 @@ def determine_group(tree, vector):
         decision[detected[i]] = weight
     return decision
 
-def get_decision_results(forest, data, fields):
-    num_trees = forest.n_estimators
+def get_decision_results(forest, data, fields, num_jobs=1):
+    data = rfdataset.from_records(data)
+    scores, detected = get_group_scores(forest, data.get_matrix(fields), num_jobs)
     results = []
-    for i, datum in enumerate(data):
-        vector = [datum[x_] for x_ in fields]
-        scores = get_group_score(forest, vector)
-        #decision = [int(round(x_ * num_trees)) for x_ in scores]
-        detected = 0
-        maxscore = scores[0]#decision[0]
-        for i, v in enumerate(scores):#decision):
-            if v > maxscore:
-                maxscore = v
-                detected = i
-#        results.append(decision)
-        results.append({'prediction':detected, 'score':scores})
+    for i in range(len(data)):
+        results.append({'prediction':int(detected[i]), 'score':scores[i].tolist()})
     return results
 
 
+def get_decisive_groups(values):
+    """Return groups given weight 1 by determine_group for leaf values [leaves x groups], -1 for no group.
+    determine_group sorts groups by values in stable order and gives weight 1 to the first group
+    only if its value is greater than the index of the second group."""
+    values = numpy.asarray(values, dtype=numpy.float64)
+    order = numpy.argsort(-values, axis=1, kind='stable')
+    groups = order[:, 0].copy()
+    if values.shape[1] > 1:
+        max_scores = values[numpy.arange(values.shape[0]), groups]
+        groups[~(max_scores > order[:, 1])] = -1
+    return groups
+
+def get_tree_accuracies(forest, matrix, labels):
+    """Ratios of samples classified by determine_group into given labels for each tree
+    @Parameters:
+        forest : RandomForestClassifier or rfclassifier
+        matrix : 2D array of samples x fields
+        labels : array of group indices of samples
+    @Return:
+        array of accuracies of trees
+    """
+    compiled = rfclassifier.from_forest(forest)
+    decisions = get_decisive_groups(compiled.value)
+    labels = numpy.asarray(labels, dtype=numpy.intp)
+    success = numpy.zeros(compiled.n_estimators, dtype=numpy.intp)
+    for start, end, leaves in compiled.iterate_leaves(matrix):
+        success += (decisions[leaves] == labels[start:end]).sum(axis=1)
+    return success / float(labels.shape[0])
+
 def select_best_tree(forest, data, fields, output_groups):#, **kwargs):
-    """find best classifier tree and give score"""
-    labels = []
-    groups = {}
-    nlabels = []
-    vectors = []
-    for datum in data:
-        output = datum[KEYWORD_OUTPUT]
-        label = None
-        for i, l in enumerate(output_groups):
-            if output == l:
-                label = i
-                break
-        if label is None:
-            raise Exception('{} cannot be classified'.format(output))
-        labels.append(label)
-        vectors.append([datum[x_] for x_ in fields])
-    best_score = 0
-    best_tree = None
-    for est in forest.estimators_:
-        success = fail = 0
-        for index, vector in enumerate(vectors):
-            decision = determine_group(est.tree_, vector)
-            if decision[labels[index]] == 1:#groups[datum.group]] == 1:
-                success += 1
-            else:
-                fail += 1
-        ratio = float(success) / (success + fail)
-        if ratio > best_score:
-            best_score = ratio
-            best_tree = est.tree_
-    if best_tree is None:
+    """find best classifier tree and give score
+    return best tree, score, accuracies of all trees"""
+    data = rfdataset.from_records(data)
+    labels = data.get_labels(output_groups)
+    unknown = numpy.nonzero(labels < 0)[0]
+    if unknown.shape[0] > 0:
+        raise Exception('{} cannot be classified'.format(data.outputs[unknown[0]]))
+    accuracies = get_tree_accuracies(forest, data.get_matrix(fields), labels)
+    best = int(numpy.argmax(accuracies)) if accuracies.shape[0] > 0 else -1
+    if best < 0 or not accuracies[best] > 0:
         raise Exception('no tree')
-    return best_tree, best_score
+    return forest.estimators_[best].tree_, float(accuracies[best]), accuracies.tolist()
 
 def __get_timestamp():
     # timestamp
@@ -459,17 +1027,24 @@ def __get_timestamp():
     return timestamp
 
 
-def load_files_and_determine_fields(filename_training, filename_diagnosis=None, field_id=None, field_output=None, verbose=False):
-    """Return (normalized traninig data set, normalized prediction data set, available fields)"""
-    trainingset = load_table(filename_training, field_id, field_output)
-    complete_missing_values(trainingset)
+def load_files_and_determine_fields(filename_training, filename_diagnosis=None, field_id=None, field_output=None, verbose=False, training_medians=False):
+    """Return (normalized traninig data set, normalized prediction data set, available fields)
+    Data sets are rfdataset objects having available fields as leading columns.
+    Missing values of prediction data set are filled with medians of training set if training_medians is True."""
+    with _profile_stage('load'):
+        trainingset = load_dataset(filename_training, field_id, field_output)
+    with _profile_stage('impute'):
+        trainingset.complete_missing_values()
+    trainingset.normalize_outputs()
     predictionset = None
-    fields = sorted([f_ for f_ in trainingset[0] if f_ not in KEYWORDS_NON_NUMERIC])
+    fields = sorted(trainingset.fields)
     if filename_diagnosis is not None and os.path.exists(filename_diagnosis):
         if filename_training != filename_diagnosis:
-            predictionset = load_table(filename_diagnosis, field_id, field_output)
-            complete_missing_values(predictionset)
-            pfields = sorted([f_ for f_ in predictionset[0] if f_ not in KEYWORDS_NON_NUMERIC])
+            with _profile_stage('load'):
+                predictionset = load_dataset(filename_diagnosis, field_id, field_output)
+            with _profile_stage('impute'):
+                predictionset.complete_missing_values(trainingset.medians if training_medians else None)
+            pfields = sorted(predictionset.fields)
             if verbose:
                 for f in pfields:
                     if f not in fields:
@@ -478,140 +1053,324 @@ def load_files_and_determine_fields(filename_training, filename_diagnosis=None,
                     if f not in pfields:
                         sys.stderr.write('{} is not included in diagnosis set\n'.format(f))
             fields = [f_ for f_ in fields if f_ in pfields]
+            predictionset.arrange(fields)
+    trainingset.arrange(fields)
     return trainingset, predictionset, fields
 
-def _obtain_forest(trainingset, predictionset, fields, num_trees, max_depth, num_iteration=0, verbose=False):
+def get_feature_counts(forest, num_fields):
+    """Count trees using each feature from flat feature arrays of all trees at once
+    @Parameters:
+        forest : RandomForestClassifier or rfclassifier
+        num_fields : number of features
+    @Return:
+        array of numbers of trees having nodes of each feature
+    """
+    compiled = rfclassifier.from_forest(forest)
+    internal = compiled.children_left != TREE_LEAF
+    trees = numpy.repeat(numpy.arange(compiled.offsets.shape[0] - 1), numpy.diff(compiled.offsets))
+    pairs = numpy.unique(trees[internal] * num_fields + compiled.feature[internal])
+    return numpy.bincount(pairs % num_fields, minlength=num_fields)
+
+PERMUTATION_REPEATS = 5
+_permutation_context = {}
+
+def _get_permutation_accuracies(compiled, matrix, labels, feature, num_repeats, seed):
+    """Accuracies of samples having shuffled values of a feature.
+    Shuffled copies of repeats are evaluated together up to 2^25 values in a batch."""
+    random = numpy.random.RandomState(None if seed is None else (seed + feature) % (2 ** 32))
+    num_samples = matrix.shape[0]
+    batch_size = max(1, (1 << 25) // max(1, matrix.size))
+    accuracies = []
+    for start in range(0, num_repeats, batch_size):
+        repeats = min(batch_size, num_repeats - start)
+        batch = numpy.tile(matrix, (repeats, 1))
+        for r in range(repeats):
+            batch[r * num_samples:(r + 1) * num_samples, feature] = matrix[random.permutation(num_samples), feature]
+        scores, predicted = compiled.predict_scores(batch)
+        accuracies += (predicted.reshape(repeats, num_samples) == labels[numpy.newaxis, :]).mean(axis=1).tolist()
+    return accuracies
+
+def _initialize_permutation_worker(arrays, matrix, labels, num_repeats, seed):
+    _permutation_context['forest'] = rfclassifier.from_arrays(arrays)
+    _permutation_context['params'] = matrix, labels
+    _permutation_context['num_repeats'] = num_repeats
+    _permutation_context['seed'] = seed
+
+def _get_permutation_accuracies_in_worker(feature):
+    matrix, labels = _permutation_context['params']
+    return _get_permutation_accuracies(_permutation_context['forest'], matrix, labels, feature, _permutation_context['num_repeats'], _permutation_context['seed'])
+
+def get_permutation_importances(forest, matrix, labels, num_repeats=PERMUTATION_REPEATS, seed=None, num_jobs=1):
+    """Mean decrease of accuracy by shuffling values of each feature, features are processed in num_jobs processes
+    @Parameters:
+        forest : RandomForestClassifier or rfclassifier
+        matrix : 2D array of samples x fields
+        labels : array of group indices of samples
+    @Return:
+        array of importances of features
+    """
+    compiled = rfclassifier.from_forest(forest)
+    matrix = numpy.ascontiguousarray(matrix, dtype=numpy.float64)
+    labels = numpy.asarray(labels, dtype=numpy.intp)
+    baseline = (compiled.predict_scores(matrix)[1] == labels).mean()
+    features = range(matrix.shape[1])
+    if num_jobs > 1 and matrix.shape[1] > 1:
+        import multiprocessing
+        pool = multiprocessing.Pool(min(num_jobs, matrix.shape[1]), _initialize_permutation_worker, (compiled.to_arrays(), matrix, labels, num_repeats, seed))
+        try:
+            accuracies = pool.map(_get_permutation_accuracies_in_worker, features)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        accuracies = [_get_permutation_accuracies(compiled, matrix, labels, f_, num_repeats, seed) for f_ in features]
+    return numpy.array([baseline - numpy.mean(a_) for a_ in accuracies], dtype=numpy.float64).reshape(-1)
+
+def _train_iteration(trainingset, fields, num_trees, max_depth, seed, max_features='sqrt'):
+    """Single round of _obtain_forest
+    return forest, fields, output_groups, accuracy, best_tree, score of best tree, feature counts, accuracies of trees, impurity importances
+    """
+    with _profile_stage('fit'):
+        forest, fields, output_groups = generate_classifier(trainingset, fields=fields, max_depth=max_depth, num_trees=num_trees, random_state=seed, max_features=max_features)
+    predicted, accuracy = predict_samples(forest, trainingset, output_groups, fields=fields)
+    with _profile_stage('best tree'):
+        tree, score, accuracies = select_best_tree(forest, trainingset, fields, output_groups)
+    counts = get_feature_counts(forest, len(fields))
+    return forest, fields, output_groups, accuracy, tree, score, counts, accuracies, forest.feature_importances_
+
+_training_context = {}
+
+def _initialize_training_worker(trainingset, fields):
+    """Keep training data in a worker process of _obtain_forest"""
+    _training_context['trainingset'] = trainingset
+    _training_context['fields'] = fields
+
+def _train_iteration_in_worker(params):
+    return _train_iteration(_training_context['trainingset'], _training_context['fields'], *params)
+
+def _obtain_forest(trainingset, predictionset, fields, num_trees, max_depth, num_iteration=0, verbose=False, num_jobs=1, seed=None, permutation_repeats=PERMUTATION_REPEATS):
     """
-    return best_forest, best_tree, feature_weigts
+    Iterations run in num_jobs processes. The i-th iteration uses seed + i as random state,
+    and results are aggregated in order of iterations to give the same results as serial runs.
+    If num_trees or max_depth is a list, parameters are selected by search_parameters before iterations.
+    feature_weights are ratios of trees using each feature, importances are impurity-based importances averaged
+    over iterations and permutation importances of best_forest for training set shuffled permutation_repeats times,
+    which are skipped if permutation_repeats is 0.
+    return best_forest, best_tree, feature_weigts, output_groups, accuracies of trees in best_forest, results of search, importances
     """
     best_accuracy = 0
     best_forest = None
+    tree_accuracies = None
     best_tree = None
     best_score = 0
     if num_iteration < 1:
         num_iteration = 1
-    loops = 0
-    weights = {}
-
-#    sys.stderr.write('____1___\n')
-#    print(num_trees, max_depth)
+    weights = numpy.zeros(len(fields), dtype=numpy.int64)
+    impurity = numpy.zeros(len(fields), dtype=numpy.float64)
+    max_features = 'sqrt'
+    search = None
 
     if isinstance(num_trees, int) is False or isinstance(max_depth, int) is False:
-        num_iteration = 1
-
-    while loops < num_iteration:
-        forest, fields, output_groups = generate_classifier(trainingset, fields=fields, max_depth=max_depth, num_trees=num_trees)
-        # if verbose:
-        #     for i, gn in enumerate(output_groups):
-        #         sys.stderr.write('Group{}\t{}\n'.format(i + 1, gn))
-
-        # calculate accuracy
-        #if verbose: sys.stderr.write('Out of bag\n')
-        predicted, accuracy = predict_samples(forest, trainingset, output_groups, fields=fields)
-        if accuracy > best_accuracy:
-            best_accuracy = accuracy
-            best_forest = forest
-        tree, score = select_best_tree(forest, trainingset, fields, output_groups)
-        if best_tree is None or score > best_score:
-            best_tree = tree
-            best_score = score
-        for est in forest.estimators_:
-            weights_ = {}
-            enumerate_features_in_tree(est.tree_, 0, weights_)#weights)
-            for w in weights_.keys(): weights[w] = weights.get(w, 0) + 1
+        trainingset = rfdataset.from_records(trainingset)
+        groups, labels = trainingset.normalize_outputs()
+        with _profile_stage('search'):
+            best, table = search_parameters(trainingset.get_matrix(fields), labels,
+                SEARCH_TREES if num_trees is None else num_trees, SEARCH_DEPTHS if max_depth is None else max_depth,
+                get_max_features_candidates(len(fields)), num_jobs=num_jobs, seed=seed, verbose=verbose)
+        num_trees, max_depth, max_features = best['num_trees'], best['depth'], best['max_features']
+        search = {'best':best, 'scores':table, 'factor':SEARCH_FACTOR}
         if verbose:
-            sys.stderr.write('{}/{}\t{:.3f}\t{:.3f}\n'.format(loops + 1, num_iteration, score, accuracy))
-        loops += 1
-#        print(loops, num_iteration, loops < num_iteration)
+            sys.stderr.write('selected num_trees={}, depth={}, max_features={}, score={:.3f}\n'.format(num_trees, max_depth, max_features, best['mean']))
+
+    params = []
+    for i in range(num_iteration):
+        params.append((num_trees, max_depth, None if seed is None else (seed + i) % (2 ** 32), max_features))
+    pool = None
+    if num_jobs > 1 and num_iteration > 1:
+        import multiprocessing
+        pool = multiprocessing.Pool(min(num_jobs, num_iteration), _initialize_training_worker, (trainingset, fields))
+        results = pool.imap(_train_iteration_in_worker, params)
+    else:
+        results = (_train_iteration(trainingset, fields, *p_) for p_ in params)
+    try:
+        for loops in range(num_iteration):
+            with _profile_stage('iteration {}'.format(loops + 1)): # waiting for workers if num_jobs > 1
+                result = next(results)
+            forest, fields, output_groups, accuracy, tree, score, counts, accuracies, importances = result
+            if accuracy > best_accuracy:
+                best_accuracy = accuracy
+                best_forest = forest
+                tree_accuracies = accuracies
+            if best_tree is None or score > best_score:
+                best_tree = tree
+                best_score = score
+            weights += counts
+            impurity += importances
+            if verbose:
+                sys.stderr.write('{}/{}\t{:.3f}\t{:.3f}\n'.format(loops + 1, num_iteration, score, accuracy))
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
     total = num_iteration * forest.get_params()['n_estimators']
     feature_weights = {}
-    for i, v in weights.items():
-        feature_weights[fields[i]] = float(v) / total
-#    print(feature_weights)
-    return best_forest, best_tree, feature_weights, output_groups
+    for i in numpy.nonzero(weights)[0]:
+        feature_weights[fields[i]] = float(weights[i]) / total
+    importances = {'impurity':dict(zip(fields, (impurity / num_iteration).tolist()))}
+    if permutation_repeats > 0:
+        trainingset = rfdataset.from_records(trainingset)
+        with _profile_stage('importance'):
+            permutation = get_permutation_importances(best_forest, trainingset.get_matrix(fields), trainingset.get_labels(output_groups), permutation_repeats, seed=seed, num_jobs=num_jobs)
+        importances['permutation'] = dict(zip(fields, permutation.tolist()))
+    return best_forest, best_tree, feature_weights, output_groups, tree_accuracies, search, importances
 
 #def diagnose_samples(forest, predictionset):
 
 ######### json
-def encode_tree(tree):
-    contents = []
-    next_ids = [0,]
-    leaf_id = sklearn.tree._tree.TREE_LEAF
-    depth = 0
-    nid = 0
-    cached_x = [0]
-    while len(next_ids) > 0:
-        next_layer = []
-        num_elems = 0
-        nodes = []
-        x = 0
-        nx = cached_x
-        cached_x = []
-        for i, nid in enumerate(next_ids):
-            lid = tree.children_left[nid]
-            rid = tree.children_right[nid]
-            contents.append({'id':nid, 'x':nx[i], 'y':depth, 'children':[lid, rid], 'feature':tree.feature[nid], 'threshold':tree.threshold[nid], 'leaf':False})
-            if tree.children_left[lid] != leaf_id: # Left node is a leaf?
-                cached_x.append(x)
-                next_layer.append(lid)
-            else:
-                leaf = {'id':lid, 'value':[float(x_) for x_ in tree.value[lid][0]], 'x':x, 'y':depth + 1, 'leaf':True}
-                contents.append(leaf)
-            x += 1
-            if tree.children_left[rid] != leaf_id: # right node is a leaf?
-                cached_x.append(x)
-                next_layer.append(rid)
-            else:
-                leaf = {'id':rid, 'value':[float(x_) for x_ in tree.value[rid][0]], 'x':x, 'y':depth + 1, 'leaf':True}
-                contents.append(leaf)
-            x += 1
-        depth += 1
-        next_ids = next_layer
-    # for c in sorted(contents, key=lambda c:c['y']):
-    #     print(c)
-    contents = sorted(contents, key=lambda x_:x_['id'])
-#    print(contents)
-#    exit()
-    return contents
-
-def encode_forest(forest):
-    trees = [encode_tree(est.tree_) for est in forest.estimators_]
-    return trees
-
-
-def pack_json_results(trainingset, predictionset, fields, predicted, best_forest, best_tree, output_groups, weight=None, condition=None):
+def get_tree_layout(children_left, children_right, offsets):
+    """Positions of nodes in tree diagrams for all trees, computed level by level with array operations.
+    Children of the k-th internal node in a layer of a tree are placed at x = 2k and 2k + 1 of the next layer.
+    @Parameters:
+        children_left, children_right : global ids of children, TREE_LEAF for leaves
+        offsets : nodes of the i-th tree are offsets[i]:offsets[i + 1]
+    @Return:
+        array of (x, y) [nodes x 2]
+    """
+    leaf_id = TREE_LEAF
+    position = numpy.zeros((children_left.shape[0], 2), dtype=numpy.int32)
+    internal = children_left != leaf_id
+    roots = numpy.asarray(offsets[:-1], dtype=numpy.intp)
+    roots = roots[roots < children_left.shape[0]]
+    frontier = roots[internal[roots]]
+    trees = numpy.nonzero(internal[roots])[0]
+    level = 0
+    while frontier.size > 0:
+        # frontier is ordered by tree and x, rank in each tree gives k
+        rank = numpy.arange(frontier.size) - numpy.searchsorted(trees, trees, side='left')
+        left = children_left[frontier]
+        right = children_right[frontier]
+        position[left, 0] = 2 * rank
+        position[right, 0] = 2 * rank + 1
+        position[left, 1] = position[right, 1] = level + 1
+        children = numpy.stack([left, right], axis=1).reshape(-1)
+        trees = numpy.repeat(trees, 2)
+        accepted = internal[children]
+        frontier = children[accepted]
+        trees = trees[accepted]
+        level += 1
+    return position
+
+def encode_tree(tree, columnar=True):
+    """Serialize a tree, see rfclassifier.serialize"""
+    return rfclassifier.from_trees([tree]).serialize(columnar)[0]
+
+def encode_forest(forest, columnar=True):
+    """Serialize trees of a forest, see rfclassifier.serialize"""
+    return rfclassifier.from_forest(forest).serialize(columnar)
+
+
+def pack_json_results(trainingset, predictionset, fields, predicted, best_forest, best_tree, output_groups, weight=None, condition=None, tree_accuracies=None, search=None, importance=None, columnar=True):
     """Compose a JSON object having all processed data.
+    Trees are serialized in columnar form unless columnar is False.
     """
-    treeout = encode_tree(best_tree)
-    forestout = encode_forest(best_forest)
-
-    success = 0
-    failure = 0
-    for i, datum in enumerate(predictionset):
-        if KEYWORD_OUTPUT in datum:
-            vector = [datum[f] for f in fields]
-            decision = evaluate(best_tree, 0, vector)
-            max_val = decision[0]
-            max_dec = 0
-            for j, v in enumerate(decision):
-                if v > max_val:
-                    max_dec = j
-                    max_val = v
-            predicted[i]['best_tree'] = max_dec # determined by best tree
-            #print('PREDICTION BY A TREE : {} => {}'.format(i, max_dec))
-    #print(predicted)
-    #exit()
+    treeout = encode_tree(best_tree, columnar)
+    forestout = encode_forest(best_forest, columnar)
+
+    trainingset = rfdataset.from_records(trainingset)
+    predictionset = rfdataset.from_records(predictionset)
+    decisions = predict_by_tree(best_tree, predictionset.get_matrix(fields))
+    for i in range(len(predictionset)):
+        predicted[i]['best_tree'] = int(decisions[i]) # determined by best tree
 
     results = {'best_tree':treeout, 'forest':forestout, 'group_label':output_groups,
-        'prediction':predicted, 'trainingset':trainingset, 'analysisset':predictionset,
+        'prediction':predicted, 'trainingset':rfrecords(trainingset), 'analysisset':rfrecords(predictionset),
         'field_id':KEYWORD_ID, 'field_out':KEYWORD_OUTPUT, 'field':fields}
     condition['num_trees'] = best_forest.get_params()['n_estimators']
     condition['depth'] = best_forest.get_params()['max_depth']
 
     if condition: results['condition'] = condition
     if weight: results['weight'] = weight
+    if tree_accuracies is not None: results['tree_accuracy'] = tree_accuracies
+    if search is not None: results['search'] = search
+    if importance is not None: results['importance'] = importance
+    if trainingset.medians is not None: results['median'] = dict([(f_, trainingset.medians[f_]) for f_ in fields])
     return results
 
+JSON_SECTIONS = ('trainingset', 'analysisset', 'prediction')
+
+def __open_json_file(filename, mode, compress=False):
+    if compress:
+        import gzip
+        return gzip.open(filename, mode + 't', compresslevel=6)
+    return open(filename, mode)
+
+def save_json_results(filename, summary, compact=False, compress=None, sections=()):
+    """Save results given by pack_json_results.
+    Compact JSON is written piece by piece without building the document in memory.
+    @Parameters:
+        filename : destination
+        summary : results
+        compact : no indentation and spaces
+        compress : gzip compression, default is True if filename ends with .gz
+        sections : keys of lists written into separated NDJSON files, e.g. JSON_SECTIONS.
+                   The document refers to them as {"ndjson":filename, "count":number of lines}.
+                   Documents having sections are always compact.
+    @Return:
+        list of written filenames
+    """
+    if compress is None:
+        compress = filename.lower().endswith('.gz')
+    if not compact and not sections:
+        with __open_json_file(filename, 'w', compress) as fo:
+            json.dump(summary, fo, indent=4, separators=(',', ': '), default=list)
+        return [filename]
+    encoder = json.JSONEncoder(separators=(',', ':'), default=list)
+    written = [filename]
+    with __open_json_file(filename, 'w', compress) as fo:
+        fo.write('{')
+        for i, (key, value) in enumerate(summary.items()):
+            if i > 0: fo.write(',')
+            fo.write(encoder.encode(key) + ':')
+            if key in sections and isinstance(value, (list, tuple, rfrecords)):
+                base = filename[0:-3] if compress and filename.lower().endswith('.gz') else filename
+                if base.lower().endswith('.json'): base = base[0:-5]
+                filename_section = '{}.{}.ndjson{}'.format(base, key, '.gz' if compress else '')
+                num = 0
+                with __open_json_file(filename_section, 'w', compress) as fs:
+                    for item in value:
+                        fs.write(encoder.encode(item) + '\n')
+                        num += 1
+                written.append(filename_section)
+                fo.write(encoder.encode({'ndjson':os.path.basename(filename_section), 'count':num}))
+            elif isinstance(value, (list, tuple, rfrecords)):
+                fo.write('[')
+                for j, item in enumerate(value):
+                    if j > 0: fo.write(',')
+                    fo.write(encoder.encode(item))
+                fo.write(']')
+            else:
+                fo.write(encoder.encode(value))
+        fo.write('}')
+    return written
+
+def load_json_results(filename, resolve=True):
+    """Load results saved by save_json_results. Gzip compression is detected by contents.
+    @Parameters:
+        resolve : replace references to NDJSON files with lists of their lines
+    """
+    with open(filename, 'rb') as fi:
+        compress = fi.read(2) == b'\x1f\x8b'
+    with __open_json_file(filename, 'r', compress) as fi:
+        summary = json.load(fi)
+    if resolve:
+        for key, value in summary.items():
+            if isinstance(value, dict) and 'ndjson' in value and 'count' in value:
+                filename_section = os.path.join(os.path.dirname(filename), value['ndjson'])
+                with open(filename_section, 'rb') as fi:
+                    compress = fi.read(2) == b'\x1f\x8b'
+                with __open_json_file(filename_section, 'r', compress) as fi:
+                    summary[key] = [json.loads(line) for line in fi if len(line.strip()) > 0]
+    return summary
 
 def execute_analysis(**kargs):
     """
@@ -623,6 +1382,10 @@ def execute_analysis(**kargs):
         id_field : field name of ID
         output_field : field name of output
         iterations : number of iterations
+        jobs : number of processes for iterations
+        seed : random seed
+        training_medians : fill missing values of diagnosis data with medians of training data
+        permutation_repeats : number of shuffles of each field for permutation importances, 0 to skip them
         verbose : verbosity
     @Rerurn
         Dict object of whole results
@@ -636,6 +1399,10 @@ def execute_analysis(**kargs):
     field_output = kargs.get('output_field', 'OUT')
     field_id = kargs.get('id_field', None)
     iterations = kargs.get('iterations', 1)
+    num_jobs = kargs.get('jobs', 1)
+    seed = kargs.get('seed', None)
+    training_medians = kargs.get('training_medians', False)
+    permutation_repeats = kargs.get('permutation_repeats', PERMUTATION_REPEATS)
     verbose = kargs.get('verbose', False)
 
     if max_depth < 2: max_depth = 2
@@ -650,25 +1417,31 @@ def execute_analysis(**kargs):
         'Iteration': iterations}
 
     # load data and define fields
-    max_depth = num_trees = None
     trainingset, predictionset, fields \
-    = load_files_and_determine_fields(filename_training=filename_training, filename_diagnosis=filename_diagnosis, field_id=field_id, field_output=field_output, verbose=verbose)
+    = load_files_and_determine_fields(filename_training=filename_training, filename_diagnosis=filename_diagnosis, field_id=field_id, field_output=field_output, verbose=verbose, training_medians=training_medians)
 
     # generate forest and select best classifier if iterations is set
-    best_forest, best_tree, weights, output_groups = _obtain_forest(trainingset, predictionset, fields, num_trees, max_depth, iterations, verbose)
+    best_forest, best_tree, weights, output_groups, tree_accuracies, search, importances = _obtain_forest(trainingset, predictionset, fields, num_trees, max_depth, iterations, verbose, num_jobs=num_jobs, seed=seed, permutation_repeats=permutation_repeats)
 
     # predict unknown samples
     if predictionset is None:
-        predictionset = copy.deepcopy(trainingset)
+        predictionset = trainingset
     predicted = get_decision_results(best_forest, predictionset, fields)
 
     # save data
     timestamp = __get_timestamp()
     filename = os.path.join(dstdir, 'report_{}.json'.format(timestamp))
-    summary = save_json_results(filename, trainingset, predictionset, fields, predicted, best_forest, best_tree, output_groups, weights, )
+    summary = pack_json_results(trainingset, predictionset, fields, predicted, best_forest, best_tree, output_groups, weights, conditions, tree_accuracies, search, importances)
+    if os.path.exists(dstdir) is False:
+        os.makedirs(dstdir)
+    save_json_results(filename, summary)
     return summary
 
 def __trim_data_fields(data, fields):
+    if isinstance(data, rfrecords):
+        data = data.dataset
+    if isinstance(data, rfdataset):
+        return rfrecords(data, [f_ for f_ in fields if f_ not in KEYWORDS_NON_NUMERIC])
     trimmed = []
     for datum in data:
         values = {}
@@ -678,38 +1451,37 @@ def __trim_data_fields(data, fields):
     return trimmed
 
 class rfclassifier(object):
-    """minimum emulation class of RandomForestClassifier object"""
+    """minimum emulation class of RandomForestClassifier object
+
+    All trees are compiled into contiguous arrays. Nodes of the i-th tree occupy
+    offsets[i]:offsets[i + 1] and children ids are global indices of the arrays.
+    """
     class rftree(object):
-        def __init__(self, size):
+        """Decision tree stored in arrays having the same layout as sklearn tree_"""
+        def __init__(self, size, num_groups=1):
             self.__size = size
-            self.children_left = [None] * size#num_trees
-            self.children_right = [None] * size#num_trees
-            self.threshold = [None] * size#num_trees
-            self.value = [None] * size#num_trees
-            self.feature = [None] * size#num_trees
-            self.position = [(-1,-1) for i in range(size)]#num_trees)]
+            self.children_left = numpy.full(size, TREE_LEAF, dtype=numpy.intp)
+            self.children_right = numpy.full(size, TREE_LEAF, dtype=numpy.intp)
+            self.threshold = numpy.full(size, numpy.nan, dtype=numpy.float64)
+            self.value = numpy.zeros((size, 1, num_groups), dtype=numpy.float64)
+            self.feature = numpy.zeros(size, dtype=numpy.intp)
+            self.position = numpy.full((size, 2), -1, dtype=numpy.int32)
+        node_count = property(lambda s:s.__size)
         def set_node(self, idnum, left_id, right_id, feature, threshold):
             self.children_left[idnum] = left_id
             self.children_right[idnum] = right_id
             self.threshold[idnum] = threshold
             self.feature[idnum] = feature
-            self.value[idnum] = None
+            self.value[idnum] = 0
         def set_leaf(self, idnum, value):
-            self.children_left[idnum] = self.children_right[idnum] = sklearn.tree._tree.TREE_LEAF
-            self.feature[idnum] = self.threshold[idnum] = None
-            self.value[idnum] = [value] # counts of each samples
-        def set_location(self, x, y):
-            self.position = (x,y)
-        def serialize(self):
-            nodes = []
-            for i in range(self.__size):
-                nodes.append({'children':(self.children_left[i], self.children_right[i]),
-                    'threshold':self.threshold[i],
-                    'value':self.value[i],
-                    'feature':self.feature[i],
-                    'x':self.position[i][0],
-                    'y':self.position[i][1]})
-            return nodes
+            self.children_left[idnum] = self.children_right[idnum] = TREE_LEAF
+            self.feature[idnum] = 0
+            self.threshold[idnum] = numpy.nan
+            self.value[idnum, 0] = value # counts of each samples
+        def set_location(self, idnum, x, y):
+            self.position[idnum] = (x, y)
+        def serialize(self, columnar=True):
+            return rfclassifier.from_trees([self]).serialize(columnar)[0]
     class rftreeholder(object):
         def __init__(self, tree):
             self.tree_ = tree
@@ -717,88 +1489,753 @@ class rfclassifier(object):
     def __init__(self, max_depth, num_trees):
         self.max_depth = max_depth
         self.num_trees = num_trees
-        self.estimators_ = []#None] * num_trees
+        self.offsets = numpy.zeros(1, dtype=numpy.intp)
+        self.children_left = numpy.zeros(0, dtype=numpy.intp)
+        self.children_right = numpy.zeros(0, dtype=numpy.intp)
+        self.feature = numpy.zeros(0, dtype=numpy.intp)
+        self.threshold = numpy.zeros(0, dtype=numpy.float64)
+        self.value = numpy.zeros((0, 0), dtype=numpy.float64)
+        self.position = numpy.zeros((0, 2), dtype=numpy.int32)
+        self.__pending = []
+        self.__scores = None
+        self.__routes = None
     def add_tree(self, treedata):
-        self.estimators_.append(rfclassifier.rftreeholder(rfclassifier.create_tree(treedata)))
-    def serialize(self):
-        forest = []
-        for i in range(self.num_trees):
-            for est in self.estimators_:
-                forest.append(est.tree_.serialize())
-        return forest
+        self.__pending.append(rfclassifier.create_tree(treedata))
+    def __compile(self):
+        """Append pending trees to the flat arrays"""
+        if len(self.__pending) == 0:
+            return
+        trees = self.__pending
+        self.__pending = []
+        sizes = [t_.children_left.shape[0] for t_ in trees]
+        offsets = numpy.concatenate([self.offsets, self.offsets[-1] + numpy.cumsum(sizes)]).astype(numpy.intp)
+        lefts = [self.children_left]
+        rights = [self.children_right]
+        for offset, t_ in zip(offsets[len(self.offsets) - 1:-1], trees):
+            left = numpy.array(t_.children_left, dtype=numpy.intp)
+            right = numpy.array(t_.children_right, dtype=numpy.intp)
+            internal = left != TREE_LEAF
+            left[internal] += offset
+            right[internal] += offset
+            lefts.append(left)
+            rights.append(right)
+        self.children_left = numpy.concatenate(lefts)
+        self.children_right = numpy.concatenate(rights)
+        feature = numpy.concatenate([self.feature] + [numpy.asarray(t_.feature, dtype=numpy.intp) for t_ in trees])
+        feature[self.children_left == TREE_LEAF] = 0 # keep indices valid, never used for leaves
+        self.feature = feature
+        self.threshold = numpy.concatenate([self.threshold] + [numpy.asarray(t_.threshold, dtype=numpy.float64) for t_ in trees])
+        values = [numpy.asarray(t_.value, dtype=numpy.float64)[:, 0, :] for t_ in trees]
+        if self.value.shape[0] > 0:
+            values = [self.value] + values
+        self.value = numpy.concatenate(values)
+        self.position = numpy.concatenate([self.position] + [getattr(t_, 'position', numpy.full((s_, 2), -1, dtype=numpy.int32)) for t_, s_ in zip(trees, sizes)]).astype(numpy.int32)
+        self.offsets = offsets
+        self.__scores = None
+        self.__routes = None
+    def __get_scores(self):
+        """Leaf values normalized in the same way as get_group_score"""
+        self.__compile()
+        if self.__scores is None:
+            leaves = self.children_left == TREE_LEAF
+            scores = numpy.zeros_like(self.value)
+            with numpy.errstate(divide='ignore', invalid='ignore'):
+                scores[leaves] = self.value[leaves] * (1.0 / self.value[leaves].sum(axis=1))[:, numpy.newaxis]
+            self.__scores = scores
+        return self.__scores
+    def __get_routes(self):
+        """Return (table of [right, left] children with self-loops on leaves, depths of trees)"""
+        self.__compile()
+        if self.__routes is None:
+            leaves = self.children_left == TREE_LEAF
+            ids = numpy.arange(self.children_left.shape[0], dtype=numpy.intp)
+            children = numpy.empty((ids.shape[0], 2), dtype=numpy.intp)
+            children[:, 0] = numpy.where(leaves, ids, self.children_right)
+            children[:, 1] = numpy.where(leaves, ids, self.children_left)
+            depths = numpy.zeros(len(self.offsets) - 1, dtype=numpy.intp)
+            frontier = self.offsets[:-1]
+            level = 0
+            while frontier.size > 0:
+                frontier = frontier[~leaves[frontier]]
+                if frontier.size == 0:
+                    break
+                level += 1
+                depths[numpy.searchsorted(self.offsets, frontier, side='right') - 1] = level
+                frontier = numpy.concatenate([self.children_left[frontier], self.children_right[frontier]])
+            self.__routes = children.reshape(-1), depths
+        return self.__routes
+    def iterate_leaves(self, matrix, chunk_size=65536):
+        """Traverse trees iteratively over chunks of rows.
+        Each tree is evaluated in the same way as evaluate(), going left when value < threshold.
+        Small chunks are evaluated in all trees at once and large chunks tree by tree.
+        yields (start row, end row, global ids of leaves [trees x rows])
+        """
+        children, depths = self.__get_routes()
+        matrix = numpy.ascontiguousarray(matrix, dtype=numpy.float64)
+        if matrix.ndim == 1:
+            matrix = matrix.reshape(1, -1)
+        num_samples, num_fields = matrix.shape
+        num_trees = depths.shape[0]
+        roots = self.offsets[:-1]
+        flat = matrix.reshape(-1)
+        chunk_size = max(1, min(chunk_size, (1 << 22) // max(1, num_trees)))
+        for start in range(0, num_samples, chunk_size):
+            end = min(num_samples, start + chunk_size)
+            base = numpy.arange(start, end, dtype=numpy.intp) * num_fields
+            if end - start < 1024:
+                nodes = numpy.tile(roots, end - start)
+                base = numpy.repeat(base, num_trees)
+                for level in range(depths.max() if num_trees > 0 else 0):
+                    go_left = flat[base + self.feature[nodes]] < self.threshold[nodes]
+                    nodes = children[(nodes << 1) + go_left]
+                leaves = nodes.reshape(end - start, num_trees).T
+            else:
+                leaves = numpy.empty((num_trees, end - start), dtype=numpy.intp)
+                for i, root in enumerate(roots):
+                    nodes = numpy.full(end - start, root, dtype=numpy.intp)
+                    for level in range(depths[i]):
+                        go_left = flat[base + self.feature[nodes]] < self.threshold[nodes]
+                        nodes = children[(nodes << 1) + go_left]
+                    leaves[i] = nodes
+            yield start, end, leaves
+    def __get_estimators(self):
+        self.__compile()
+        estimators = []
+        for i in range(len(self.offsets) - 1):
+            start, end = self.offsets[i], self.offsets[i + 1]
+            tree = rfclassifier.rftree(end - start, self.value.shape[1])
+            left = self.children_left[start:end].copy()
+            right = self.children_right[start:end].copy()
+            internal = left != TREE_LEAF
+            left[internal] -= start
+            right[internal] -= start
+            tree.children_left = left
+            tree.children_right = right
+            tree.feature = self.feature[start:end]
+            tree.threshold = self.threshold[start:end]
+            tree.value = self.value[start:end, numpy.newaxis, :]
+            tree.position = self.position[start:end]
+            estimators.append(rfclassifier.rftreeholder(tree))
+        return estimators
+    estimators_ = property(__get_estimators)
+    leaf_scores = property(__get_scores)
+    n_estimators = property(lambda s:len(s.offsets) - 1 + len(s._rfclassifier__pending))
+    def apply(self, matrix, chunk_size=65536):
+        """Return global ids of leaves [samples x trees] reached by rows of matrix"""
+        matrix = numpy.asarray(matrix, dtype=numpy.float64)
+        if matrix.ndim == 1:
+            matrix = matrix.reshape(1, -1)
+        leaves = numpy.empty((matrix.shape[0], self.n_estimators), dtype=numpy.intp)
+        for start, end, block in self.iterate_leaves(matrix, chunk_size):
+            leaves[start:end] = block.T
+        return leaves
+    def predict_scores(self, matrix, chunk_size=65536):
+        """Batched version of get_group_score.
+        @Return:
+            (array of normalized scores [samples x groups], array of predicted group indices)
+        """
+        matrix = numpy.asarray(matrix, dtype=numpy.float64)
+        if matrix.ndim == 1:
+            matrix = matrix.reshape(1, -1)
+        table = self.leaf_scores
+        scores = numpy.zeros((matrix.shape[0], table.shape[1]), dtype=numpy.float64)
+        for start, end, block in self.iterate_leaves(matrix, chunk_size):
+            for nodes in block:
+                scores[start:end] += table[nodes]
+        scores /= max(1, self.n_estimators)
+        return scores, numpy.argmax(scores, axis=1)
+    def serialize(self, columnar=True):
+        """Convert trees into JSON-compatible objects.
+        In columnar form, a tree is a dict of parallel lists of nodes, children_left, children_right,
+        feature, threshold, value, x and y. Leaves have TREE_LEAF as children and -2 as feature and threshold.
+        Otherwise a tree is a list of node dicts sorted by id, {id, x, y, children, feature, threshold, leaf:False}
+        for branches and {id, x, y, value, leaf:True} for leaves.
+        """
+        self.__compile()
+        position = self.position
+        if position.shape[0] > 0 and position.min() < 0: # not laid out
+            position = get_tree_layout(self.children_left, self.children_right, self.offsets)
+        leaves = self.children_left == TREE_LEAF
+        children_left = numpy.where(leaves, TREE_LEAF, self.children_left - numpy.repeat(self.offsets[:-1], numpy.diff(self.offsets)))
+        children_right = numpy.where(leaves, TREE_LEAF, self.children_right - numpy.repeat(self.offsets[:-1], numpy.diff(self.offsets)))
+        feature = numpy.where(leaves, -2, self.feature)
+        threshold = numpy.where(leaves, -2.0, self.threshold)
+        trees = []
+        for i in range(len(self.offsets) - 1):
+            start, end = self.offsets[i], self.offsets[i + 1]
+            tree = {'children_left':children_left[start:end].tolist(), 'children_right':children_right[start:end].tolist(),
+                'feature':feature[start:end].tolist(), 'threshold':threshold[start:end].tolist(),
+                'value':self.value[start:end].tolist(), 'x':position[start:end, 0].tolist(), 'y':position[start:end, 1].tolist()}
+            if not columnar:
+                nodes = []
+                for j, left in enumerate(tree['children_left']):
+                    if left == TREE_LEAF:
+                        nodes.append({'id':j, 'value':tree['value'][j], 'x':tree['x'][j], 'y':tree['y'][j], 'leaf':True})
+                    else:
+                        nodes.append({'id':j, 'x':tree['x'][j], 'y':tree['y'][j], 'children':[left, tree['children_right'][j]],
+                            'feature':tree['feature'][j], 'threshold':tree['threshold'][j], 'leaf':False})
+                tree = nodes
+            trees.append(tree)
+        return trees
     def __repr__(self):
         return json.dumps(self.serialize())
     @classmethod
     def create_tree(cls, treedata):
-        tree = rfclassifier.rftree(len(treedata))
+        """Create rftree from a tree serialized in columnar form or as node dicts"""
+        if isinstance(treedata, dict): # columnar
+            left = numpy.asarray(treedata['children_left'], dtype=numpy.intp)
+            value = numpy.asarray(treedata['value'], dtype=numpy.float64).reshape(left.shape[0], -1)
+            tree = rfclassifier.rftree(left.shape[0], value.shape[1])
+            leaves = left == TREE_LEAF
+            tree.children_left = left
+            tree.children_right = numpy.asarray(treedata['children_right'], dtype=numpy.intp)
+            tree.feature = numpy.where(leaves, 0, numpy.asarray(treedata['feature'], dtype=numpy.intp))
+            tree.threshold = numpy.where(leaves, numpy.nan, numpy.asarray(treedata['threshold'], dtype=numpy.float64))
+            tree.value = value[:, numpy.newaxis, :]
+            if 'x' in treedata and 'y' in treedata:
+                tree.position = numpy.stack([treedata['x'], treedata['y']], axis=1).astype(numpy.int32).reshape(-1, 2)
+            return tree
+        num_groups = 1
+        for node in treedata:
+            if node['leaf']:
+                num_groups = len(node['value'])
+                break
+        tree = rfclassifier.rftree(len(treedata), num_groups)
         for i, node in enumerate(treedata):
             if node['leaf']:
                 tree.set_leaf(i, node['value'])
             else:
                 children = node['children']
                 tree.set_node(i, children[0], children[1], node['feature'], node['threshold'])
+            tree.set_location(i, node.get('x', -1), node.get('y', -1))
         return tree
-
-
-def predict_group_by_preset_model(filename_model, filename_input):
-    """Prediction using previously calculated model
+    @classmethod
+    def from_trees(cls, trees, max_depth=None):
+        """Compile tree_ objects of sklearn estimators or rftree objects"""
+        forest = rfclassifier(max_depth, len(trees))
+        forest.__pending = list(trees)
+        forest.__compile()
+        return forest
+    def to_arrays(self):
+        """Return flat arrays including derived tables for save_binary_model"""
+        children, depths = self.__get_routes()
+        return {'offsets':self.offsets, 'children_left':self.children_left, 'children_right':self.children_right,
+            'feature':self.feature, 'threshold':self.threshold, 'value':self.value, 'position':self.position,
+            'routes':children, 'depths':depths, 'leaf_scores':self.leaf_scores}
+    @classmethod
+    def from_arrays(cls, arrays, max_depth=None):
+        """Wrap arrays given by to_arrays without copying them"""
+        forest = rfclassifier(max_depth, len(arrays['offsets']) - 1)
+        for key in 'offsets', 'children_left', 'children_right', 'feature', 'threshold', 'value', 'position':
+            setattr(forest, key, arrays[key])
+        if 'routes' in arrays and 'depths' in arrays:
+            forest.__routes = arrays['routes'], arrays['depths']
+        forest.__scores = arrays.get('leaf_scores', None)
+        return forest
+    @classmethod
+    def from_forest(cls, forest):
+        """Compile RandomForestClassifier object"""
+        if isinstance(forest, rfclassifier):
+            return forest
+        return rfclassifier.from_trees([est.tree_ for est in forest.estimators_], forest.get_params()['max_depth'])
+
+MODEL_MAGIC = b'AICMODL1'
+MODEL_ALIGNMENT = 64
+MODEL_HEADER_FIELDS = ('field', 'group_label', 'condition', 'weight', 'field_id', 'field_out', 'tree_accuracy', 'median', 'importance')
+
+def save_binary_model(filename, model):
+    """Save fields, group labels, conditions and flat forest arrays of a model.
+    The file consists of MODEL_MAGIC, header length (8 bytes, little endian),
+    JSON header and raw arrays aligned to MODEL_ALIGNMENT bytes.
+    @Parameters:
+        filename : destination
+        model : dict object given by pack_json_results
     """
-    with open(filename_model) as fi:
-        model = json.load(fi)
+    import struct
+    conditions = model['condition']
+    forest = rfclassifier(conditions.get('depth', None), len(model['forest']))
+    for tree in model['forest']:
+        forest.add_tree(tree)
+    best_tree = rfclassifier.from_trees([rfclassifier.create_tree(model['best_tree'])])
+    arrays = []
+    for prefix, compiled in ('forest', forest), ('best_tree', best_tree):
+        for key, array in sorted(compiled.to_arrays().items()):
+            arrays.append(('{}.{}'.format(prefix, key), numpy.ascontiguousarray(array)))
+    header = {'arrays':{}}
+    for key in MODEL_HEADER_FIELDS:
+        if key in model:
+            header[key] = model[key]
+    # offsets of arrays are relative to the end of header
+    offset = 0
+    for name, array in arrays:
+        header['arrays'][name] = {'dtype':array.dtype.str, 'shape':list(array.shape), 'offset':offset}
+        offset += -(-array.nbytes // MODEL_ALIGNMENT) * MODEL_ALIGNMENT
+    contents = json.dumps(header, separators=(',', ':')).encode('utf-8')
+    start = len(MODEL_MAGIC) + 8 + len(contents)
+    contents += b' ' * (-start % MODEL_ALIGNMENT)
+    with open(filename, 'wb') as fo:
+        fo.write(MODEL_MAGIC)
+        fo.write(struct.pack('<Q', len(contents)))
+        fo.write(contents)
+        for name, array in arrays:
+            data = array.tobytes()
+            fo.write(data)
+            fo.write(b'\0' * (-len(data) % MODEL_ALIGNMENT))
+    return filename
+
+def load_binary_model(filename):
+    """Load a model saved by save_binary_model using memory mapping.
+    Arrays are not copied, processes loading the same file share pages.
+    @Return:
+        (model dict without trees, rfclassifier of forest, rfclassifier of best tree)
+    """
+    import struct
+    with open(filename, 'rb') as fi:
+        if fi.read(len(MODEL_MAGIC)) != MODEL_MAGIC:
+            raise Exception('{} is not a binary model'.format(filename))
+        size = struct.unpack('<Q', fi.read(8))[0]
+        header = json.loads(fi.read(size).decode('utf-8'))
+    start = len(MODEL_MAGIC) + 8 + size
+    buf = numpy.memmap(filename, dtype=numpy.uint8, mode='r')
+    arrays = {'forest':{}, 'best_tree':{}}
+    for name, spec in header.pop('arrays').items():
+        prefix, key = name.split('.', 1)
+        dtype = numpy.dtype(spec['dtype'])
+        count = int(numpy.prod(spec['shape'], dtype=numpy.int64))
+        offset = start + spec['offset']
+        arrays[prefix][key] = buf[offset:offset + count * dtype.itemsize].view(dtype).reshape(spec['shape'])
+    max_depth = header['condition'].get('depth', None)
+    forest = rfclassifier.from_arrays(arrays['forest'], max_depth)
+    best_tree = rfclassifier.from_arrays(arrays['best_tree'], max_depth)
+    return header, forest, best_tree
+
+_model_cache = collections.OrderedDict()
+_model_cache_size = 0
+
+def __get_file_digest(filename):
+    import hashlib
+    digest = hashlib.sha1()
+    with open(filename, 'rb') as fi:
+        while 1:
+            block = fi.read(1 << 20)
+            if not block: break
+            digest.update(block)
+    return digest.hexdigest()
+
+def _create_model_forests(model):
+    """Return (rfclassifier of forest, rfclassifier of best tree) of a model given by pack_json_results"""
+    conditions = model['condition']
+    forest = rfclassifier(conditions['depth'], conditions['num_trees'])
+    for tree in model['forest']:
+        forest.add_tree(tree)
+    best_tree = rfclassifier.from_trees([rfclassifier.create_tree(model['best_tree'])])
+    return forest, best_tree
+
+def load_model(filename_model):
+    """Load a model saved as JSON or binary file.
+    JSON models are kept in memory up to _model_cache_size, keyed by file contents.
+    Binary models are not cached since they are memory mapped.
+    @Return:
+        (model dict, rfclassifier of forest, rfclassifier of best tree)
+    """
+    with open(filename_model, 'rb') as fi:
+        magic = fi.read(len(MODEL_MAGIC))
+    if magic == MODEL_MAGIC:
+        return load_binary_model(filename_model)
+    key = None
+    if _model_cache_size > 0:
+        key = __get_file_digest(filename_model)
+        if key in _model_cache:
+            cached = _model_cache.pop(key)
+            _model_cache[key] = cached
+            return cached
+    model = load_json_results(filename_model, resolve=False)
+    forest, best_tree = _create_model_forests(model)
+    if key is not None:
+        _model_cache[key] = model, forest, best_tree
+        while len(_model_cache) > _model_cache_size:
+            _model_cache.popitem(last=False)
+    return model, forest, best_tree
+
+def predict_group_by_preset_model(filename_model, filename_input, training_medians=False, columnar=True, num_jobs=1):
+    """Prediction using previously calculated model saved as JSON or binary file, rows are scored in num_jobs processes
+    Missing values are filled with medians of training data kept in the model if training_medians is True,
+    otherwise medians of input data are used. Trees of binary models are serialized in columnar form unless columnar is False.
+    """
+    with _profile_stage('model'):
+        model, forest, best_tree = load_model(filename_model)
     fields = model['field']
     group_labels = model['group_label']
-    rf = model['forest']
     conditions = model['condition']
-    num_trees = conditions['num_trees']
-    max_depth = conditions['depth']
-    forest = []
     idcolumn = conditions['id_column']
     outcolumn = conditions['out_column']
 
-    #print(model['field_id'])
-    #print(model['field_out'])
-    #exit()
-    forest = rfclassifier(max_depth, num_trees)
-    for tree in rf:
-        forest.add_tree(tree)
-    best_tree = rfclassifier.create_tree(model['best_tree'])
-    inputdata = load_table(filename_input, idcolumn, outcolumn)
-    complete_missing_values(inputdata)
+    with _profile_stage('load'):
+        inputdata = load_dataset(filename_input, idcolumn, outcolumn, fields)
+    medians = model.get('median', None) if training_medians else None
+    if training_medians and medians is None:
+        sys.stderr.write('{} has no medians of training data\n'.format(filename_model))
+    with _profile_stage('impute'):
+        inputdata.complete_missing_values(medians)
     results = {}
-    for field in 'condition', 'group_label', 'forest', 'weight', 'field_id', 'field_out', 'best_tree':
-        results[field] = model[field]
-    predicted = []
-    for individual in inputdata:#model['forest']:
-        vector = []
-        for field in model['field']:
-            vector.append(individual.get(field, None))
-        scores = get_group_score(forest, vector)
-        best_group = 0
-        best_score = scores[0]
-        for i in range(1, len(scores)):
-            if scores[i] > best_score:
-                best_group = i
-                best_score = scores[i]
-        best_group_solo = 0
-        scores_solo = evaluate(best_tree, 0, vector)
-        best_score = scores[0]
-        for i in range(1, len(scores)):
-            if scores_solo[i] > best_score:
-                best_group_solo = i
-                best_score = scores_solo[i]
-        predicted.append({'score':[x_ / sum(scores) for x_ in scores], 'prediction':best_group, 'best_tree':best_group_solo})
+    for field in 'condition', 'group_label', 'weight', 'field_id', 'field_out', 'tree_accuracy', 'median', 'importance':
+        if field in model:
+            results[field] = model[field]
+    results['forest'] = model['forest'] if 'forest' in model else forest.serialize(columnar)
+    results['best_tree'] = model['best_tree'] if 'best_tree' in model else best_tree.serialize(columnar)[0]
+    matrix = inputdata.get_matrix(fields)
+    if medians is not None: # fields absent from input
+        for j, field in enumerate(fields):
+            if field not in inputdata.field_index:
+                matrix[:, j] = medians[field]
+    with _profile_stage('decision'):
+        scores, best_groups = get_group_scores(forest, matrix, num_jobs)
+        scores /= scores.sum(axis=1)[:, numpy.newaxis]
+        best_groups_solo = predict_by_tree(best_tree, matrix)
+        predicted = []
+        for i in range(len(inputdata)):
+            predicted.append({'score':scores[i].tolist(), 'prediction':int(best_groups[i]), 'best_tree':int(best_groups_solo[i])})
     results['prediction'] = predicted
-    results['analysisset'] =  inputdata
+    results['analysisset'] =  rfrecords(inputdata)
     results['field'] = fields
     results['group_label'] = group_labels
     results['condition'] = conditions
     return results
 
-if __name__ == '__main__':
+COMPILED_NESTING = 32 # nested levels of comparisons in a generated function, deeper subtrees become separated functions
+COMPILED_BATCH_SIZE = 256 # rows scored by generated functions, larger batches are scored by rfclassifier.predict_scores
+COMPILED_VERSION = 1 # changes of generated code invalidate cached sources
+
+def __float_literal(value):
+    value = float(value)
+    if math.isinf(value) or math.isnan(value):
+        return "float('{}')".format(value)
+    return repr(value)
+
+def __generate_tree_code(arrays, root, leaf_lines, call_lines, leaf_value, prefix, functions):
+    """Nested comparisons of a tree from root node, going left when x[feature] < threshold as evaluate()
+    @Parameters:
+        arrays : flat arrays of rfclassifier
+        leaf_lines : function returning statements at a leaf node
+        call_lines : function returning statements using a generated function of a deeper subtree
+        leaf_value : function returning an expression of a leaf node returned by functions of subtrees
+        functions : list of sources of generated functions to be extended
+    @Return:
+        list of lines indented from the level of a function body
+    """
+    children_left, children_right = arrays['children_left'], arrays['children_right']
+    feature, threshold = arrays['feature'], arrays['threshold']
+    lines = []
+    stack = [(int(root), 1)]
+    while len(stack) > 0:
+        node, level = stack.pop()
+        indent = '    ' * level
+        if isinstance(node, basestring):
+            lines.append(indent + node)
+        elif children_left[node] == TREE_LEAF:
+            lines.extend([indent + s_ for s_ in leaf_lines(node)])
+        elif level > COMPILED_NESTING:
+            name = '_{}_{}'.format(prefix, node)
+            body = __generate_tree_code(arrays, node, lambda n_:['return ' + leaf_value(n_)],
+                lambda f_:['return {}(x)'.format(f_)], leaf_value, prefix, functions)
+            functions.append('\n'.join(['def {}(x):'.format(name)] + body))
+            lines.extend([indent + s_ for s_ in call_lines(name)])
+        else:
+            lines.append(indent + 'if x[{}] < {}:'.format(int(feature[node]), __float_literal(threshold[node])))
+            stack.append((int(children_right[node]), level + 1))
+            stack.append(('else:', level))
+            stack.append((int(children_left[node]), level + 1))
+    return lines
+
+def generate_forest_source(forest, best_tree):
+    """Generate Python source of a module scoring a row by nested comparisons without loops over nodes.
+    forest_scores(x) returns a tuple of averaged normalized scores of groups as rfclassifier.predict_scores and
+    get_group_score, adding leaf scores tree by tree in the same order so that results are identical.
+    best_tree(x) returns the index of the group having the maximum value at the leaf of the best tree.
+    x is a sequence of values of model fields, missing values (NaN) go right.
+    """
+    arrays = forest.to_arrays()
+    num_trees = len(arrays['offsets']) - 1
+    table = arrays['leaf_scores']
+    num_groups = table.shape[1]
+    sums = ['s{}'.format(k_) for k_ in range(num_groups)]
+    functions = []
+    def add_scores(node):
+        lines = ['{} += {}'.format(sums[k_], __float_literal(v_)) for k_, v_ in enumerate(table[node]) if v_ != 0]
+        return lines if len(lines) > 0 else ['pass']
+    def add_returned_scores(name):
+        return ['t = {}(x)'.format(name)] + ['{} += t[{}]'.format(s_, k_) for k_, s_ in enumerate(sums)]
+    def leaf_scores(node):
+        return '({},)'.format(', '.join([__float_literal(v_) for v_ in table[node]]))
+    source = ['# generated by rfprediction.generate_forest_source, {} trees and {} groups'.format(num_trees, num_groups),
+        '', 'def forest_scores(x):', '    {} = 0.0'.format(' = '.join(sums))]
+    for i in range(num_trees):
+        source.extend(__generate_tree_code(arrays, arrays['offsets'][i], add_scores, add_returned_scores, leaf_scores, 't{}'.format(i), functions))
+    source.append('    return ({},)'.format(', '.join(['{} / {}'.format(s_, __float_literal(max(1, num_trees))) for s_ in sums])))
+
+    arrays = best_tree.to_arrays()
+    groups = numpy.argmax(arrays['value'], axis=1)
+    group = lambda n_:str(int(groups[n_]))
+    source.extend(['', 'def best_tree(x):'])
+    source.extend(__generate_tree_code(arrays, arrays['offsets'][0], lambda n_:['return ' + group(n_)],
+        lambda f_:['return {}(x)'.format(f_)], group, 'b', functions))
+    for function in functions:
+        source.extend(['', function])
+    return '\n'.join(source) + '\n'
+
+def __get_compiled_header(digest, body):
+    import hashlib
+    return '# rfprediction forest {} source {}\n'.format(digest, hashlib.sha1(body.encode('utf-8')).hexdigest())
+
+def compile_forest(forest, best_tree, cache_dir=None):
+    """Compile the source given by generate_forest_source into functions forest_scores(x) and best_tree(x).
+    If cache_dir (or _table_cache_dir if None) is set, the source is cached in the directory as forest_<digest>.py
+    keyed by SHA-1 of the trees. The first line has the digest of the trees and SHA-1 of the following source,
+    and files not matching them are generated again before execution.
+    @Return:
+        dict having forest_scores and best_tree
+    """
+    import hashlib
+    digest = hashlib.sha1(str(COMPILED_VERSION).encode('ascii'))
+    for compiled in forest, best_tree:
+        arrays = compiled.to_arrays()
+        for key in 'offsets', 'children_left', 'children_right', 'feature', 'threshold', 'value':
+            digest.update(numpy.ascontiguousarray(arrays[key]).tobytes())
+    digest = digest.hexdigest()
+    if cache_dir is None:
+        cache_dir = _table_cache_dir
+    filename = None if cache_dir is None else os.path.join(cache_dir, 'forest_{}.py'.format(digest))
+    body = None
+    if filename is not None and os.path.exists(filename):
+        with open(filename) as fi:
+            header = fi.readline()
+            cached = fi.read()
+        if header == __get_compiled_header(digest, cached):
+            body = cached
+            os.utime(filename, None) # recently used
+        else:
+            sys.stderr.write('{} does not match the forest, generated again\n'.format(filename))
+    if body is None:
+        body = generate_forest_source(forest, best_tree)
+        if filename is not None:
+            try:
+                if os.path.exists(cache_dir) is False:
+                    os.makedirs(cache_dir)
+                fd, filename_tmp = tempfile.mkstemp('.tmp', 'forest', cache_dir)
+                with os.fdopen(fd, 'w') as fo:
+                    fo.write(__get_compiled_header(digest, body))
+                    fo.write(body)
+                os.replace(filename_tmp, filename)
+                __evict_table_cache(cache_dir, _table_cache_size)
+            except (IOError, OSError) as e:
+                sys.stderr.write('cannot cache compiled forest {} : {}\n'.format(filename, e))
+    namespace = {}
+    exec(compile(body, filename or '<forest {}>'.format(digest[:16]), 'exec'), namespace)
+    return namespace
+
+class rfpredictor(object):
+    """Scoring records given as dicts with a model kept in memory.
+    predictor = rfpredictor.load('model.model')
+    predictor.predict_one({'Family':1, 'Work':2, ...})
+    Missing, empty and negative values and absent fields are filled with medians of training data in the model.
+    """
+    def __init__(self, model, forest, best_tree, compiled=None):
+        self.model = model
+        self.fields = list(model['field'])
+        self.group_labels = list(model['group_label'])
+        self.field_index = dict([(f_, i_) for i_, f_ in enumerate(self.fields)])
+        medians = model.get('median', None) or {}
+        self.medians = numpy.array([medians.get(f_, numpy.nan) for f_ in self.fields], dtype=numpy.float64)
+        self.forest = rfclassifier.from_forest(forest)
+        self.best_tree = best_tree if isinstance(best_tree, rfclassifier) else rfclassifier.from_trees([best_tree])
+        self.compiled = compiled
+    @classmethod
+    def load(cls, model, compiled=False):
+        """Create a predictor from a filename of JSON or binary model or a dict given by pack_json_results.
+        If compiled is True, batches up to COMPILED_BATCH_SIZE records are scored by functions given by compile_forest,
+        whose source is cached in _table_cache_dir if it is set.
+        """
+        if isinstance(model, basestring):
+            model, forest, best_tree = load_model(model)
+        else:
+            forest, best_tree = _create_model_forests(model)
+        predictor = rfpredictor(model, forest, best_tree)
+        if compiled:
+            predictor.compiled = compile_forest(predictor.forest, predictor.best_tree)
+        return predictor
+    def get_matrix(self, records):
+        """Convert records into a matrix of model fields having medians as missing values"""
+        matrix = numpy.full((len(records), len(self.fields)), numpy.nan, dtype=numpy.float64)
+        for i, record in enumerate(records):
+            for field, value in record.items():
+                j = self.field_index.get(field, None)
+                if j is None or value is None: continue
+                try:
+                    matrix[i, j] = float(value)
+                except (TypeError, ValueError): # empty or non-numeric cells
+                    pass
+        matrix[matrix < 0] = numpy.nan
+        missing = numpy.isnan(matrix)
+        if missing.any():
+            numpy.copyto(matrix, numpy.broadcast_to(self.medians, matrix.shape), where=missing)
+        return matrix
+    def predict_many(self, records):
+        """Predict groups of records
+        @Return:
+            list of {'group':label, 'prediction':group index, 'score':normalized scores of groups,
+            'best_tree':group index decided by the best tree}
+        """
+        if len(records) == 0:
+            return []
+        matrix = self.get_matrix(records)
+        if self.compiled is not None and len(records) <= COMPILED_BATCH_SIZE:
+            rows = matrix.tolist()
+            forest_scores, best_tree = self.compiled['forest_scores'], self.compiled['best_tree']
+            scores = numpy.array([forest_scores(r_) for r_ in rows], dtype=numpy.float64)
+            decisions = numpy.argmax(scores, axis=1)
+            solo = numpy.array([best_tree(r_) for r_ in rows], dtype=numpy.intp)
+        else:
+            scores, decisions = self.forest.predict_scores(matrix)
+            solo = predict_by_tree(self.best_tree, matrix)
+        scores /= scores.sum(axis=1)[:, numpy.newaxis]
+        results = []
+        for score, d_, b_ in zip(scores.tolist(), decisions.tolist(), solo.tolist()):
+            results.append({'group':self.group_labels[d_], 'prediction':d_, 'score':score, 'best_tree':b_})
+        return results
+    def predict_one(self, record):
+        """Predict the group of a record, see predict_many"""
+        return self.predict_many([record])[0]
+
+_predictor_cache = collections.OrderedDict()
+_compiled_predictors = False
+
+def get_predictor(filename_model, compiled=None):
+    """Return rfpredictor of a model file, up to max(1, _model_cache_size) predictors are kept
+    until their files are modified. Predictors are compiled if compiled is True, or _compiled_predictors if None."""
+    if compiled is None:
+        compiled = _compiled_predictors
+    stat = os.stat(filename_model)
+    key = os.path.abspath(filename_model), stat.st_mtime, stat.st_size, bool(compiled)
+    if key in _predictor_cache:
+        predictor = _predictor_cache.pop(key)
+    else:
+        predictor = rfpredictor.load(filename_model, compiled)
+    _predictor_cache[key] = predictor
+    while len(_predictor_cache) > max(1, _model_cache_size):
+        _predictor_cache.popitem(last=False)
+    return predictor
+
+STREAM_QUEUE_SIZE = 4 # chunks waiting in each stage of predict_stream
+
+def __iterate_in_thread(iterable, queue_size=STREAM_QUEUE_SIZE):
+    """Yield items of iterable consumed in a background thread up to queue_size items ahead"""
+    import threading, queue
+    items = queue.Queue(queue_size)
+    finished = object()
+    def produce():
+        try:
+            for item in iterable:
+                items.put((item, None))
+            items.put((finished, None))
+        except BaseException as e:
+            items.put((finished, e))
+    thread = threading.Thread(target=produce)
+    thread.daemon = True # not to block exit if the consumer fails
+    thread.start()
+    while 1:
+        item, error = items.get()
+        if item is finished:
+            if error is not None:
+                raise error
+            break
+        yield item
+
+def __write_stream_chunk(ostr, output_format, ids, group_labels, scores, decisions):
+    if output_format == 'ndjson':
+        for name, d_, score in zip(ids, decisions.tolist(), scores.tolist()):
+            ostr.write(json.dumps({'id':name, 'prediction':group_labels[d_], 'score':score}) + '\n')
+    else:
+        import csv
+        labels = [group_labels[d_] for d_ in decisions.tolist()]
+        csv.writer(ostr, lineterminator='\n').writerows(zip(ids, labels, *scores.T.tolist()))
+
+def predict_stream(filename_model, filename_input, output=None, output_format='csv', chunk_size=LOADING_CHUNK_SIZE):
+    """Score a table chunk by chunk and write ID, predicted group and scores of groups of each row.
+    Reading, scoring and writing run in separated threads connected by queues of STREAM_QUEUE_SIZE chunks,
+    so memory usage does not depend on the size of the input.
+    Missing values are filled with medians of training data kept in the model since medians of
+    the whole input are unknown until the end, so results do not depend on chunk_size.
+    Models without medians of all fields (saved by older versions) are rejected before reading the input.
+    @Parameters:
+        output : destination filename, standard output if None or '-', gzip compressed if it ends with .gz
+        output_format : 'csv' (ID, prediction and columns of group labels) or 'ndjson' ({"id", "prediction", "score"})
+    @Return:
+        number of written rows
+    """
+    import threading, queue
+    with _profile_stage('model'):
+        model, forest, best_tree = load_model(filename_model)
+    fields = model['field']
+    group_labels = model['group_label']
+    conditions = model['condition']
+    medians = model.get('median', None) or {}
+    lacking = [f_ for f_ in fields if f_ not in medians]
+    if len(lacking) > 0:
+        raise Exception('{} has no medians of training data of {} fields (e.g. {}) required by --stream, '
+            'train the model again or use --model without --stream'.format(filename_model, len(lacking), lacking[0]))
+    names, chunks = iterate_table_chunks(filename_input, conditions['id_column'], conditions['out_column'], chunk_size, fields)
+
+    if output is None or output == '-':
+        ostr = sys.stdout
+    else:
+        ostr = __open_json_file(output, 'w', output.lower().endswith('.gz'))
+    results = queue.Queue(STREAM_QUEUE_SIZE)
+    errors = []
+    def write():
+        try:
+            if output_format != 'ndjson':
+                import csv
+                csv.writer(ostr, lineterminator='\n').writerow(['ID', 'prediction'] + list(group_labels))
+            while 1:
+                result = results.get()
+                if result is None: break
+                __write_stream_chunk(ostr, output_format, *result)
+        except BaseException as e:
+            errors.append(e)
+            while results.get() is not None: pass # keep the scoring thread running until the end
+    writer = threading.Thread(target=write)
+    writer.start()
+    num_rows = 0
+    try:
+        for ids, outputs, matrix, available in __iterate_in_thread(chunks):
+            if len(errors) > 0: break
+            if len(ids) == 0: continue
+            chunk = rfdataset(names, matrix, ids, outputs)
+            chunk.complete_missing_values(medians)
+            matrix = chunk.get_matrix(fields)
+            for j, field in enumerate(fields): # fields absent from input
+                if field not in chunk.field_index:
+                    matrix[:, j] = medians[field]
+            scores, decisions = get_group_scores(forest, matrix)
+            scores /= scores.sum(axis=1)[:, numpy.newaxis]
+            results.put((ids, group_labels, scores, decisions))
+            num_rows += len(ids)
+    finally:
+        results.put(None)
+        writer.join()
+        if ostr is not sys.stdout:
+            ostr.close()
+        else:
+            ostr.flush()
+    if len(errors) > 0:
+        raise errors[0]
+    return num_rows
+
+def _get_argument_parser():
     parser = argparse.ArgumentParser()
     parser.add_argument('-i', default=None, help='input CSV file', metavar='filename')
     parser.add_argument('-t', help='training data', default=None, metavar='filename')
-    parser.add_argument('-o', default='out', help='output directory', metavar='directory')
+    parser.add_argument('-o', default=None, help='output directory (default out), or output file of --stream (default standard output)', metavar='directory')
     parser.add_argument('-n', default='20', help='number of trees', metavar='number')
     parser.add_argument('-d', default='4', help='maximum depth of decision tree', metavar='number')
     parser.add_argument('-F', default="OUT", help='output column', metavar='field name')
@@ -806,27 +2243,77 @@ if __name__ == '__main__':
     parser.add_argument('--best', default=None, metavar='filename', help='output best tree (PDF)')
     parser.add_argument('--verbose', action='store_true', help='verbosity')
     parser.add_argument('--without-rawdata', action='store_true', help='remove rawdata from report')
+    parser.add_argument('--without-binary-model', action='store_true', help='do not write the binary model (.model) next to the JSON file')
     parser.add_argument('--iteration', default='0', help='the number of iteration to estimate weights of parameters')
     parser.add_argument('--key', metavar='characters', default=None, help='unique ID')
-    parser.add_argument('--model', metavar='json file', default=None, help='JSON filename of model')
-
-    args = parser.parse_args()
+    parser.add_argument('--model', metavar='json file', default=None, help='JSON or binary (.model) filename of model')
+    parser.add_argument('--training-medians', action='store_true', help='fill missing values of analysis data with medians of training data')
+    parser.add_argument('--compact', action='store_true', help='write JSON without indentation')
+    parser.add_argument('--gzip', action='store_true', help='compress JSON output with gzip (.json.gz)')
+    parser.add_argument('--ndjson', action='store_true', help='write training set, analysis set and predictions into separated NDJSON files')
+    parser.add_argument('--node-dict', action='store_true', help='write trees as lists of node objects as older versions')
+    parser.add_argument('--stream', default=None, choices=('csv', 'ndjson'), help='with --model, write ID, prediction and scores of each row of input into -o (- for standard output) reading input chunk by chunk')
+
+    parser.add_argument('--jobs', type=int, default=1, metavar='number', help='number of processes for iterations, parameter search and scoring')
+    parser.add_argument('--permutation-repeats', type=int, default=PERMUTATION_REPEATS, metavar='number', help='number of shuffles of each field for permutation importances, 0 to write only impurity-based importances')
+    parser.add_argument('--seed', type=int, default=None, metavar='number', help='random seed, iterations use seed, seed+1, ...')
+    parser.add_argument('--serve', action='store_true', help='run as a worker processing jobs given as JSON lines from standard input')
+    parser.add_argument('--compiled', action='store_true', help='with --serve, score records of predict jobs by Python code generated from trees, cached in the directory of --cache')
+    parser.add_argument('--model-cache', type=int, default=4, metavar='number', help='number of models kept in memory by the worker')
+    parser.add_argument('--page-size', type=int, default=None, metavar='number', help='number of rows of the data table in the HTML report, following rows are written into page files')
+    parser.add_argument('--uncertain', type=int, default=0, metavar='number', help='number of the most uncertain samples drawn with the histogram of scores in the HTML report')
+    parser.add_argument('--profile', action='store_true', help='record time and peak RSS of each stage as "profile" in the JSON output')
+    parser.add_argument('--profile-memory', action='store_true', help='also record peak of memory allocated by Python in each stage with tracemalloc, which slows down the run (implies --profile)')
+    parser.add_argument('--profile-stats', default=None, metavar='directory', help='save cProfile statistics of each stage in the directory (implies --profile)')
+    parser.add_argument('--cache', default=None, metavar='directory', help='directory to cache parsed input tables')
+    parser.add_argument('--cache-size', type=int, default=1024, metavar='MB', help='maximum size of files in the cache directory')
+    return parser
+
+def run(args):
+    """Execute model construction or prediction with parsed command line arguments.
+    @Return:
+        filename of JSON output
+    """
 
+    global _table_cache_dir, _table_cache_size, _profiler
     timestamp = __get_timestamp()
-    dstdir = args.o
+    dstdir = args.o if args.o is not None else 'out'
     filename_model = args.model
-
+    _table_cache_dir = args.cache
+    _table_cache_size = max(0, args.cache_size) << 20
+    if _profiler is not None:
+        _profiler.close()
+    _profiler = rfprofiler(args.profile_stats, args.profile_memory) if args.profile or args.profile_stats is not None or args.profile_memory else None
+    try:
+        return __run(args, timestamp, dstdir, filename_model)
+    finally:
+        if _profiler is not None:
+            _profiler.close()
+            if args.verbose:
+                _profiler.write(sys.stderr)
+
+def __run(args, timestamp, dstdir, filename_model):
     if filename_model is None:
-        if args.t is not None and args.t.endswith('.json'): # JSON model
+        if args.t is not None and (args.t.endswith('.json') or args.t.endswith('.json.gz')): # JSON model
             filename_model = args.t
     else:
         if args.t is not None:
             raise Exception('Either model construction or prediction can be executed')
 
+    if args.stream is not None: # scores are written without JSON and reports
+        if filename_model is None:
+            raise Exception('--stream requires a model given by --model')
+        with _profile_stage('stream'):
+            num_rows = predict_stream(filename_model, args.i, args.o, args.stream)
+        output = args.o if args.o is not None else '-'
+        if args.verbose:
+            sys.stderr.write('{} rows were written into {}\n'.format(num_rows, output))
+        return output
+
     if filename_model is not None: # prediction using preset model
 #        if args.t is not None:
 #            raise Exception('Prediction mode does not use training data')
-        summary = predict_group_by_preset_model(args.model, args.i)
+        summary = predict_group_by_preset_model(filename_model, args.i, args.training_medians, not args.node_dict, args.jobs)
 #        print(summary)
 #        exit()
     else: # prediction mode
@@ -874,6 +2361,8 @@ if __name__ == '__main__':
         conditions['iterations'] = iteration
         conditions['id_column'] = args.I
         conditions['out_column'] = args.F
+        conditions['seed'] = args.seed if args.seed is not None else numpy.random.randint(0, 2 ** 31 - 1)
+        conditions['training_medians'] = args.training_medians
         verbose = args.verbose
 
         if args.verbose:
@@ -881,7 +2370,6 @@ if __name__ == '__main__':
                 sys.stderr.write('{}\t{}\n'.format(key, value))
 
         filename_prediction = args.i if args.i is not None else args.t
-        iteration = args.iteration
 
         # data loading
         try:
@@ -890,46 +2378,119 @@ if __name__ == '__main__':
                                               filename_diagnosis=conditions['analysis_data_file'],
                                               field_id=conditions['id_column'],
                                               field_output=conditions['out_column'],
-                                              verbose=verbose)
+                                              verbose=verbose,
+                                              training_medians=args.training_medians)
         except Exception as e:
             sys.stderr.write('error while loading : ' + repr(e))
             raise
         # forest formation
         try:
-            best_forest, best_tree, weights, output_groups = _obtain_forest(trainingset, predictionset, fields, num_trees, depth, iteration, verbose)
+            best_forest, best_tree, weights, output_groups, tree_accuracies, search, importances \
+            = _obtain_forest(trainingset, predictionset, fields, num_trees, depth, iteration, verbose, num_jobs=args.jobs, seed=conditions['seed'], permutation_repeats=max(0, args.permutation_repeats))
         except Exception as e:
             sys.stderr.write('error while forest formation : ' + repr(e))
             raise
         # prediction
         if predictionset is None:
-            predictionset = copy.deepcopy(trainingset)
+            predictionset = trainingset
         try:
-            predicted = get_decision_results(best_forest, predictionset, fields)
+            with _profile_stage('decision'):
+                predicted = get_decision_results(best_forest, predictionset, fields, args.jobs)
         except Exception as e:
             sys.stderr.write('error while prediction : ' + e)
             raise e
 
         # Save data
-        summary = pack_json_results(trainingset, predictionset, fields, predicted, best_forest, best_tree, output_groups, weights, conditions)
+        with _profile_stage('pack'):
+            summary = pack_json_results(trainingset, predictionset, fields, predicted, best_forest, best_tree, output_groups, weights, conditions, tree_accuracies, search, importances, not args.node_dict)
     if args.key: # unique key for interaction with other processes
         summary['key'] = args.key
     if args.without_rawdata: # remove rawdata for privacy concern
         fields = [KEYWORD_ID, KEYWORD_OUTPUT]
         summary['trainingset'] = __trim_data_fields(summary['trainingset'], fields)
-        summary['analysisset'] = __trim_data_fields(summary['trainingset'], fields)
+        summary['analysisset'] = __trim_data_fields(summary['analysisset'], fields)
 
-    if dstdir.lower().endswith('.json'): # save JSON only
+    compress = args.gzip or dstdir.lower().endswith('.json.gz')
+    sections = JSON_SECTIONS if args.ndjson else ()
+    if dstdir.lower().endswith('.json') or dstdir.lower().endswith('.json.gz'): # save JSON only
         filename = dstdir
-        dstdir = None
-        with open(filename, 'w') as fo:
-            json.dump(summary, fo, indent=4, separators=(',', ': '))
+        if compress and not filename.lower().endswith('.gz'):
+            filename += '.gz'
+        filename_binary = filename[0:filename.lower().rfind('.json')] + '.model'
     else: # HTML reports
         if os.path.exists(dstdir) is False:
             os.makedirs(dstdir)
-
-        filename = os.path.join(dstdir, 'report_{}.json'.format(timestamp))
-        with open(filename, 'w') as fo:
-            json.dump(summary, fo, indent=4, separators=(',', ': '))
+        filename = os.path.join(dstdir, 'report_{}.json{}'.format(timestamp, '.gz' if compress else ''))
+        filename_binary = os.path.join(dstdir, 'report_{}.model'.format(timestamp))
         # visualization
         import rfreport
-        rfreport.generate_report_document(summary, dstdir, timestamp=timestamp)
+        rfreport._bar_chart_uncertain = max(0, args.uncertain)
+        with _profile_stage('report'):
+            rfreport.generate_report_document(summary, dstdir, timestamp=timestamp, page_size=args.page_size)
+    if _profiler is not None: # stages until now, saving is recorded only in the profiler
+        summary['profile'] = list(_profiler.stages)
+    with _profile_stage('save'):
+        save_json_results(filename, summary, compact=args.compact, compress=compress, sections=sections)
+        if filename_model is None and not args.without_binary_model: # binary model for prediction
+            save_binary_model(filename_binary, summary)
+    return filename
+
+def serve(instream=None, outstream=None):
+    """Worker mode processing jobs given as JSON lines to avoid startup cost of each process.
+    A job is {"id":..., "args":[command line arguments]} and its response is
+    {"id":..., "status":"success", "output":filename} or {"id":..., "status":"error", "error":message}.
+    A job {"id":..., "command":"predict", "model":filename, "records":[dicts of fields and values]} scores records
+    by rfpredictor without files and responds {"id":..., "status":"success", "predictions":[results of predict_many]}.
+    Predict jobs may have "compiled":true or false to override --compiled of the worker.
+    A job {"command":"exit"} stops the worker.
+    --model-cache, --cache and --cache-size of the worker are kept unless a job gives them explicitly.
+    """
+    global _model_cache_size
+    if instream is None: instream = sys.stdin
+    if outstream is None: outstream = sys.stdout
+    parser = _get_argument_parser()
+    while 1:
+        line = instream.readline()
+        if not line: break
+        line = line.strip()
+        if len(line) == 0: continue
+        job_id = None
+        stdout = sys.stdout
+        try:
+            job = json.loads(line)
+            job_id = job.get('id', None)
+            if job.get('command', None) == 'exit': break
+            if job.get('command', None) == 'predict': # single records without files
+                records = job.get('records', [])
+                if isinstance(records, dict): records = [records]
+                response = {'id':job_id, 'status':'success', 'predictions':get_predictor(job['model'], job.get('compiled', None)).predict_many(records)}
+            else:
+                sys.stdout = sys.stderr # keep the response stream clean
+                args = parser.parse_args([str(x_) for x_ in job.get('args', [])])
+                for key, value in ('model_cache', _model_cache_size), ('cache', _table_cache_dir), ('cache_size', _table_cache_size >> 20):
+                    if getattr(args, key) == parser.get_default(key): # not given by the job
+                        setattr(args, key, value)
+                _model_cache_size = max(0, args.model_cache)
+                response = {'id':job_id, 'status':'success', 'output':run(args)}
+                if _profiler is not None:
+                    response['profile'] = _profiler.stages
+        except KeyboardInterrupt:
+            raise
+        except BaseException as e: # SystemExit is raised by argument errors
+            sys.stderr.write('error in job {} : {}\n'.format(job_id, repr(e)))
+            response = {'id':job_id, 'status':'error', 'error':repr(e)}
+        finally:
+            sys.stdout = stdout
+        outstream.write(json.dumps(response) + '\n')
+        outstream.flush()
+
+if __name__ == '__main__':
+    args = _get_argument_parser().parse_args()
+    if args.serve:
+        _model_cache_size = max(0, args.model_cache)
+        _compiled_predictors = args.compiled
+        _table_cache_dir = args.cache
+        _table_cache_size = max(0, args.cache_size) << 20
+        serve()
+    else:
+        run(args)
@@ -1,11 +1,13 @@
-import os, sys, re, argparse, math
+import os, sys, re, argparse, math, json
 import tempfile
+import concurrent.futures
+import numpy
 import PIL.Image as Image
 import PIL.ImageDraw as ImageDraw
 import PIL.ImageFont as ImageFont
 
 try:
-    import urllib.request as urllib2
+    import urllib.parse as urllib2 # quote, lighter than urllib.request
 except ImportError:
     import urllib2
 
@@ -42,22 +44,24 @@ th{white-space:nowrap;}
 
 __MARKER_COLORS = ((255,100,100), (100,255,100), (100,100,255), (224,192,0), (128,0,192), (90,224,192))
 
-def draw_bar_chart(names, predicted, group_labels=None, size=400, filename=None):
-    """Bar chart
-    """
-    if filename is None:
-        filename_bar = tempfile.mktemp('.png')
-    else:
-        filename_bar = filename
-    image = Image.new('RGB', (size, size))
-    draw = ImageDraw.ImageDraw(image)
-    draw.rectangle(((0,0),(size,size)), fill=(255,255,255))
+_report_jobs = None # processes drawing images of a report, None for the number of CPUs
+_bar_chart_rows = 100 # bar charts of more samples are drawn as histograms
+_bar_chart_uncertain = 0 # number of the most uncertain samples drawn below histograms
+_report_executor = None
+_template_cache = {} # template filename : (modification time, parsed template)
+
+def _text_size(draw, text):
+    """Size of text drawn with the default font, ImageDraw.textsize was removed in Pillow 10"""
+    if hasattr(draw, 'textbbox'):
+        box = draw.textbbox((0, 0), text)
+        return box[2] - box[0], box[3] - box[1]
+    return draw.textsize(text)
+
+def __draw_sample_bars(draw, names, predicted, group_labels, size, top, height):
+    """Draw a stacked bar of scores and the predicted label of each sample in the area from top to top + height"""
     num_individuals = len(predicted)
-#    num_trees = forest.n_estimators
-    p = len(names)
-    ycnv = lambda i : ((i + .5) * size) / (num_individuals + 1)
+    ycnv = lambda i : top + ((i + .5) * height) / (num_individuals + 1)
     xcnv = lambda p : float((p + 0.15) * size * 0.7)
-    draw.rectangle(((0,0),(size,size)), fill=(255,255,255))
     colors = __MARKER_COLORS
 
     for i, result in enumerate(predicted):
@@ -76,7 +80,7 @@ def draw_bar_chart(names, predicted, group_labels=None, size=400, filename=None)
         spacer = size * 0.02
         x0 = xcnv(0)
         x1 = xcnv(1)
-        draw.text((x0 - draw.textsize(name)[0] - spacer, y0), name, fill=(0,0,0))
+        draw.text((x0 - _text_size(draw, name)[0] - spacer, y0), name, fill=(0,0,0))
         score = result.get('score', [])
         decision = int(result.get('prediction', None))
         if decision is not None:#s[i] is not None:#output_groups is not None:
@@ -89,19 +93,105 @@ def draw_bar_chart(names, predicted, group_labels=None, size=400, filename=None)
             #label = output_groups[decisions[i]]
 
             draw.text((x1 + spacer, y0), label, fill=color)
+
+def get_score_histogram(scores, decisions, num_groups, num_bins=20):
+    """Count samples in bins of the normalized score of the predicted group.
+    @Parameters:
+        scores : array of scores [samples x groups]
+        decisions : array of predicted groups
+        num_bins : number of bins dividing [0, 1]
+    @Return:
+        array of counts [groups x bins]
+    """
+    confidence = scores[numpy.arange(scores.shape[0]), decisions]
+    bins = numpy.minimum((confidence * num_bins).astype(numpy.intp), num_bins - 1)
+    return numpy.bincount(decisions * num_bins + bins, minlength=num_groups * num_bins).reshape(num_groups, num_bins)
+
+def __draw_score_histogram(draw, histogram, group_labels, size, top, height):
+    """Draw counts given by get_score_histogram as stacked bars of predicted groups"""
+    colors = __MARKER_COLORS
+    num_groups, num_bins = histogram.shape
+    totals = histogram.sum(axis=0)
+    cmax = max(1, int(totals.max()))
+    left, right = size * 0.12, size * 0.95
+    bottom = top + height - 30
+    ceil = top + 10
+    bw = (right - left) / num_bins
+    for b in range(num_bins):
+        y = bottom
+        for g in range(num_groups):
+            count = histogram[g, b]
+            if count == 0: continue
+            dy = (bottom - ceil) * count / cmax
+            draw.rectangle(((left + bw * b, y - dy), (left + bw * (b + 1), y)), outline=(0,0,0), fill=colors[g % len(colors)])
+            y -= dy
+    draw.rectangle(((left, ceil), (right, bottom)), outline=(0,0,0))
+    for v in 0, 0.5, 1:
+        label = '{}'.format(v)
+        draw.text((left + (right - left) * v - _text_size(draw, label)[0] / 2, bottom + 2), label, fill=(0,0,0))
+    for c in 0, cmax:
+        label = '{}'.format(c)
+        draw.text((left - _text_size(draw, label)[0] - 4, bottom - (bottom - ceil) * c / cmax - 6), label, fill=(0,0,0))
+    lx = left
+    for g in range(num_groups): # legend
+        label = group_labels[g] if group_labels is not None else '{}'.format(g)
+        draw.rectangle(((lx, top + height - 14), (lx + 10, top + height - 4)), outline=(0,0,0), fill=colors[g % len(colors)])
+        draw.text((lx + 14, top + height - 16), label, fill=(0,0,0))
+        lx += _text_size(draw, label)[0] + 24
+
+def draw_bar_chart(names, predicted, group_labels=None, size=400, filename=None, max_rows=None, num_uncertain=0):
+    """Bar chart of scores of each sample.
+    Charts of more than max_rows samples are histograms of the score of the predicted group
+    stacked by groups, followed by bars of num_uncertain samples having the smallest margins
+    between the first and the second scores.
+    """
+    if filename is None:
+        filename_bar = tempfile.mktemp('.png')
+    else:
+        filename_bar = filename
+    image = Image.new('RGB', (size, size))
+    draw = ImageDraw.ImageDraw(image)
+    draw.rectangle(((0,0),(size,size)), fill=(255,255,255))
+    if max_rows is None or len(predicted) <= max_rows:
+        __draw_sample_bars(draw, names, predicted, group_labels, size, 0, size)
+    else:
+        scores = numpy.array([result['score'] for result in predicted], dtype=numpy.float64)
+        scores /= numpy.maximum(scores.sum(axis=1, keepdims=True), 1e-300)
+        decisions = numpy.array([int(result['prediction']) for result in predicted], dtype=numpy.intp)
+        num_uncertain = min(num_uncertain, len(predicted))
+        height = size if num_uncertain <= 0 else size // 2
+        histogram = get_score_histogram(scores, decisions, max(scores.shape[1], int(decisions.max()) + 1))
+        __draw_score_histogram(draw, histogram, group_labels, size, 0, height)
+        if num_uncertain > 0:
+            ordered = numpy.sort(scores, axis=1)
+            margins = ordered[:, -1] - ordered[:, -2] if scores.shape[1] > 1 else ordered[:, -1]
+            selected = numpy.argpartition(margins, num_uncertain - 1)[:num_uncertain]
+            selected = selected[numpy.argsort(margins[selected], kind='stable')]
+            __draw_sample_bars(draw, [names[i] for i in selected], [predicted[i] for i in selected], group_labels, size, height, size - height)
     image.save(filename_bar)
     return filename_bar
 
-def draw_weight_chart(weight, size=400, filename=None):
+def draw_weight_chart(weight, size=400, filename=None, importance=None):
     """Draw a graph of parameter weights
+    @Parameters:
+        weight : dict of field name and weight
+        importance : dict of label and dict of field name and importance drawn with weights
     """
     if filename is None:
         filename = tempfile.mktemp('.png')
+    series = [weight]
+    labels = ['Occurrence']
+    if importance:
+        for label in sorted(importance.keys()):
+            labels.append(label[0].upper() + label[1:])
+            series.append(importance[label])
     w, h = size, size
     image = Image.new('RGB', (w, h))
     draw = ImageDraw.ImageDraw(image)
     draw.rectangle(((0,0),(size,size)), fill=(255,255,255), outline=(255,255,255))
-    wmax = max(weight.values())
+    wmax = max([max(list(s_.values()) + [0]) for s_ in series])
+    if wmax <= 0:
+        wmax = 1.0
     fig = math.floor(math.log10(wmax))
     rem = math.log10(wmax) - fig
     if 0 < rem < 0.3:
@@ -120,25 +210,43 @@ def draw_weight_chart(weight, size=400, filename=None):
     x1 = xcnv(vmax)
     for v in 0, vmax:
         label = '{}'.format(v)
-        draw.text((xcnv(v) - draw.textsize(label)[0] / 2, 0), label, fill=(0,0,0))
-    color = 0, 128, 0
+        draw.text((xcnv(v) - _text_size(draw, label)[0] / 2, 0), label, fill=(0,0,0))
+    colors = ((0, 128, 0), (0, 0, 128), (192, 96, 0))
     offset = dy * 0.25
+    sh = bh / len(series)
     for key in sorted(weight.keys(), key=lambda x_:weight[x_], reverse=True):
-        value = weight[key]
-        x = xcnv(value)
-        draw.rectangle(((x0, y+offset), (x,y+bh + offset)), outline=(0,0,0), fill=color)
-        draw.text((x0 - draw.textsize(key)[0] - 5, y), key, fill=(0,0,0))
+        for i, values in enumerate(series):
+            x = xcnv(min(vmax, max(0, values.get(key, 0))))
+            draw.rectangle(((x0, y + offset + sh * i), (x, y + offset + sh * (i + 1))), outline=(0,0,0), fill=colors[i % len(colors)])
+        draw.text((x0 - _text_size(draw, key)[0] - 5, y), key, fill=(0,0,0))
         y += dy
     y0 = dy
     y1 = dy * (len(weight) + 1.5)
     draw.rectangle(((x0,y0),(x1,y1)), outline=(0,0,0))
+    if len(series) > 1: # legend
+        lx = 10
+        for i, label in enumerate(labels):
+            draw.rectangle(((lx, h - 14), (lx + 10, h - 4)), outline=(0,0,0), fill=colors[i % len(colors)])
+            draw.text((lx + 14, h - 16), label, fill=(0,0,0))
+            lx += _text_size(draw, label)[0] + 24
     image.save(filename)
     return filename
 
+def __expand_tree(tree):
+    """Convert a tree in columnar form into a list of node objects"""
+    nodes = []
+    for i, left in enumerate(tree['children_left']):
+        if left < 0:
+            nodes.append({'id':i, 'value':tree['value'][i], 'x':tree['x'][i], 'y':tree['y'][i], 'leaf':True})
+        else:
+            nodes.append({'id':i, 'x':tree['x'][i], 'y':tree['y'][i], 'children':[left, tree['children_right'][i]],
+                'feature':tree['feature'][i], 'threshold':tree['threshold'][i], 'leaf':False})
+    return nodes
+
 def draw_treemodel(tree, fields, size=400, filename=None):#**kwargs):
     """Draw a tree and save as PNG file
     @Parameters:
-        tree : Decision tree converted from a skleran tree object in random forest
+        tree : Decision tree converted from a skleran tree object in random forest (columnar form or list of nodes)
         fields : applied fields
         size : graph size
         filename : destination
@@ -147,6 +255,8 @@ def draw_treemodel(tree, fields, size=400, filename=None):#**kwargs):
     """
     if filename is None:
         filename = tempfile.mktemp('.png')
+    if isinstance(tree, dict):
+        tree = __expand_tree(tree)
     image = Image.new('RGB', (size, size))
     draw = ImageDraw.ImageDraw(image)
     draw.rectangle(((0,0),(size,size)), fill=(255,255,255), outline=(255,255,255))
@@ -190,13 +300,13 @@ def draw_treemodel(tree, fields, size=400, filename=None):#**kwargs):
             threshold = node['threshold']
             draw.rectangle(((bx,by),(bx+bw_,by+bh)),outline=(10,10,20))
             cnd = '{} < {:.2f}'.format(fields[field], threshold)
-            tw = draw.textsize(cnd)[0]
+            tw = _text_size(draw, cnd)[0]
             if tw <= bw_:
                 draw.text((bx + (bw_ - tw) / 2, by + toffset), cnd, fill=(0,0,0))
             else:
-                draw.text((bx + (bw_ - draw.textsize(fields[field])[0]) / 2, by + toffset - bh // 4), fields[field], fill=(0,0,0))
+                draw.text((bx + (bw_ - _text_size(draw, fields[field])[0]) / 2, by + toffset - bh // 4), fields[field], fill=(0,0,0))
                 label = ' < {:.2f}'.format(threshold)
-                draw.text((bx + (bw_ - draw.textsize(label)[0]) / 2, by + toffset + bh // 4), label, fill=(0,0,0))
+                draw.text((bx + (bw_ - _text_size(draw, label)[0]) / 2, by + toffset + bh // 4), label, fill=(0,0,0))
 
             for child in children:
 #                print(child, len(tree))
@@ -234,42 +344,81 @@ def draw_treemodel(tree, fields, size=400, filename=None):#**kwargs):
     image.save(filename)
     return filename
 
-def __format_data_table(data, fields=None):
+__page_template = """<!DOCTYPE HTML>
+<html>
+<head>
+<title>{title}</title>
+<style type="text/css">
+body {{font-size:small; margin:5%; }}
+#prediction_table tr:nth-child(even){{background:#eee;}}
+#prediction_table {{border:1px solid black; border-spacing:0; font-size:x-small; font-family:monospace;}}
+thead{{font-weight:bold; background:#444;color:white;}}
+td{{white-space:nowrap;}}
+th{{white-space:nowrap;}}
+.failure {{color:#f00;}}
+</style>
+</head>
+<body>
+"""
+
+def __get_table_fields(data, fields=None):
+    """Determine columns of the data table scanning rows once
+    @Return:
+        list of fields present in the analysis set
+    """
     table = data['analysisset']
     fi = data.get('field_id', None)
     fo = data.get('field_out', None)
-    group_labels = data.get('group_label', None)
     if fields is None:
         fields = []
         if fi is not None: fields.append(fi)
         if fo is not None: fields.append(fo)
-        fields = fields + sorted([f for f in table[0].keys() if f != fi and f != fo])
-    else:
-        accepted = False
-        header = []
-        if fi not in fields: header.append(fi)
-        if fo not in fields:
-            for row in table:
-                if fo in row:
-                    header.append(fo)
-                    break
-    flds = []
-    for f in fields:
-        accepted = False
-        for datum in table:
-            if f in datum:
-                accepted = True
-                break
-        if accepted: flds.append(f)
-    fields = header + flds#ields
+        return fields + sorted([f for f in table[0].keys() if f != fi and f != fo])
+    header = []
+    if fi not in fields: header.append(fi)
+    wanted = set(fields)
+    wanted.add(fo)
+    present = set()
+    for datum in table:
+        present.update(f for f in datum.keys() if f in wanted)
+        if len(present) == len(wanted): break
+    if fo not in fields and fo in present:
+        header.append(fo)
+    return header + [f for f in fields if f in present]
+
+def __get_page_filename(timestamp, page):
+    return 'report_{}_page{}.html'.format(timestamp, page + 1)
 
+def __write_page_links(fo, timestamp, page, num_pages):
+    links = ['<a href="report_{}.html">Report</a>'.format(timestamp)]
+    for i in range(1, num_pages):
+        if i == page:
+            links.append('{}'.format(i + 1))
+        else:
+            links.append('<a href="{}">{}</a>'.format(__get_page_filename(timestamp, i), i + 1))
+    fo.write('<p class="pages">{}</p>\n'.format(' | '.join(links)))
+
+def write_data_table(stream, data, fields=None, page_size=None, dstdir=None, timestamp=None):
+    """Write the table of analysis set and predictions into a file row by row.
+    @Parameters:
+        stream : destination file object
+        data : all data
+        fields : displayed fields, all fields of the first row if None
+        page_size : number of rows written into stream, following rows go to page files
+            report_<timestamp>_page<n>.html in dstdir linked from the table. All rows are written into stream if None
+        dstdir, timestamp : directory and unique id of the page files
+    """
+    table = data['analysisset']
+    fi = data.get('field_id', None)
+    fo = data.get('field_out', None)
+    group_labels = data.get('group_label', None)
+    fields = __get_table_fields(data, fields)
     decision = data.get('prediction', None)
-    contents = '<table id="prediction_table">\n'
 
     # header, fields
-    contents += '<thead><tr>'
+    header = ['<table id="prediction_table">\n<thead><tr>']
     if decision is not None:
-        contents += '<th>Predicted</th>'
+        header.append('<th>Predicted</th>')
     for f in fields:
         if f == fi:
             label = 'ID'
@@ -277,36 +426,90 @@ def __format_data_table(data, fields=None):
             label = 'Observed'
         else:
             label = f
-        contents += '<th>{}</td>'.format(label)
-    contents += '</tr></thead>\n<tbody>'
+        header.append('<th>{}</td>'.format(label))
+    header.append('</tr></thead>\n<tbody>')
+    header = ''.join(header)
+    footer = '</tbody></table>\n'
 
+    num_rows = len(table)
+    if page_size is None or page_size <= 0 or num_rows <= page_size:
+        page_size = num_pages = None
+    else:
+        num_pages = (num_rows + page_size - 1) // page_size
+    if num_pages is not None:
+        __write_page_links(stream, timestamp, 0, num_pages)
+    out = stream
+    out.write(header)
+    page = 0
     # values
     for i, datum in enumerate(table):
+        if page_size is not None and i > 0 and i % page_size == 0: # next page
+            out.write(footer)
+            if out is not stream:
+                __write_page_links(out, timestamp, page, num_pages)
+                out.write('</body>\n</html>\n')
+                out.close()
+            page += 1
+            out = open(os.path.join(dstdir, __get_page_filename(timestamp, page)), 'w')
+            out.write(__page_template.format(title='Results {}/{}'.format(page + 1, num_pages)))
+            __write_page_links(out, timestamp, page, num_pages)
+            out.write(header)
+        cells = ['<tr>']
         if decision is not None:
             d = int(decision[i]['prediction'])
             gp = group_labels[d]
             gg = datum.get(fo, None)
             if gp == gg:
-                elem = '<tr class="success">'
+                cells[0] = '<tr class="success">'
             elif gg is not None:
-                elem = '<tr class="failure">'
-            else:
-                elem = '<tr>'
-        contents += elem#'<tr>'
-        if decision is not None:
-            d = int(decision[i]['prediction'])
+                cells[0] = '<tr class="failure">'
             if group_labels is not None and 0 <= d < len(group_labels):
-                contents += '<td>{}</td>'.format(group_labels[d])
+                cells.append('<td>{}</td>'.format(group_labels[d]))
             else:
-                contents += '<td>{}</td>'.format(d)
+                cells.append('<td>{}</td>'.format(d))
         for f in fields:
             val = datum.get(f, '')
             if isinstance(val, float) and (val - round(val) < 1e-4):
                 val = int(val)
-            contents += '<td>{}</td>'.format(val)
-        contents += '</tr>\n'
-    contents += '</tbody></table>\n'
-    return contents
+            cells.append('<td>{}</td>'.format(val))
+        cells.append('</tr>\n')
+        out.write(''.join(cells))
+    out.write(footer)
+    if out is not stream:
+        __write_page_links(out, timestamp, page, num_pages)
+        out.write('</body>\n</html>\n')
+        out.close()
+
+def __format_data_table(data, fields=None):
+    import io
+    buf = io.StringIO()
+    write_data_table(buf, data, fields)
+    return buf.getvalue()
+
+def __get_report_asset(key, data, dstdir, timestamp):
+    """Determine an image of the report without drawing it.
+    @Return:
+        (HTML element, drawing function, keyword arguments) or None if the key is not an image or data are missing
+    """
+    if key == 'bargraph':
+        if 'prediction' in data and 'analysisset' in data:
+            field = data['field_id']
+            names = [datum[field] for datum in data['analysisset']]
+            filename = 'bar_{}.png'.format(timestamp)
+            return '<img src="{}" id="bargraph">'.format(filename), draw_bar_chart, \
+                {'names':names, 'predicted':list(data['prediction']), 'group_labels':data.get('group_label', None), 'filename':os.path.join(dstdir, filename),
+                'max_rows':_bar_chart_rows, 'num_uncertain':_bar_chart_uncertain}
+    elif key == 'best_tree':
+        if 'best_tree' in data:
+            filename = 'tree_{}.png'.format(timestamp)
+            return '<img src="{}" id="besttree">'.format(filename), draw_treemodel, \
+                {'tree':data['best_tree'], 'fields':data['field'], 'filename':os.path.join(dstdir, filename)}
+    elif key == 'weightgraph':
+        if 'weight' in data:
+            filename = 'weight_{}.png'.format(timestamp)
+            return '<img src="{}" id="weightgraph">'.format(filename), draw_weight_chart, \
+                {'weight':data['weight'], 'filename':os.path.join(dstdir, filename), 'importance':data.get('importance', None)}
+    return None
 
 def generate_report(key, data, dstdir, timestamp, verbose=False):
     """Replace HTML keywords with processed texts, figures or tables.
@@ -321,19 +524,11 @@ def generate_report(key, data, dstdir, timestamp, verbose=False):
     if verbose:
         sys.stderr.write('PROCESSING : {}\n'.format(key))
     try:
-        if key == 'bargraph':
-            if 'prediction' in data and 'analysisset' in data:
-                field = data['field_id']
-                names = [datum[field] for datum in data['analysisset']]
-                filename = 'bar_{}.png'.format(timestamp)
-                group_labels = data.get('group_label', None)
-                draw_bar_chart(names, data['prediction'], group_labels=group_labels, filename=os.path.join(dstdir, filename))
-                return '<img src="{}" id="bargraph">'.format(filename)
-        elif key == 'best_tree':
-            if 'best_tree' in data:
-                filename = 'tree_{}.png'.format(timestamp)
-                draw_treemodel(data['best_tree'], data['field'], filename=os.path.join(dstdir, filename))
-                return '<img src="{}" id="besttree">'.format(filename)
+        asset = __get_report_asset(key, data, dstdir, timestamp)
+        if asset is not None:
+            element, function, kwargs = asset
+            function(**kwargs)
+            return element
         elif key == 'best_score':
             if 'best_tree' in data and 'prediction' in data:
                 pred = data['prediction']
@@ -352,12 +547,6 @@ def generate_report(key, data, dstdir, timestamp, verbose=False):
                             failure += 1
                 if success + failure > 0:
                     return '<span id="best_tree_score">{:.2f}%</span>'.format(success * 100.0 / (success + failure))
-        elif key == 'weightgraph':
-            if 'weight' in data:
-                weight = data['weight']
-                filename = 'weight_{}.png'.format(timestamp)
-                draw_weight_chart(weight, filename=os.path.join(dstdir, filename))
-                return '<img src="{}" id="weightgraph">'.format(filename)
         elif key == 'datatable':
             if 'analysisset' in data:
                 return __format_data_table(data, data.get('field', None))
@@ -392,45 +581,114 @@ def __get_timestamp():
 def __get_default_contents():
     return __default_template
 
-def generate_report_document(data, destination, filename_template=None, timestamp=None):
+def __parse_template(contents):
+    """Split a template into a list of (kind, text) where kind is 'text', 'value' for <%=name%> or 'key' for <%key%>"""
+    pat = re.compile('<%(.*?)%>', re.M)
+    segments = []
+    pos = 0
+    while 1:
+        m = pat.search(contents, pos)
+        if m is None: break
+        segments.append(('text', contents[pos:m.start()]))
+        label = m.group(1).strip()
+        if label[0] == '=':
+            segments.append(('value', label[1:].strip()))
+        else:
+            segments.append(('key', label))
+        pos = m.end()
+    segments.append(('text', contents[pos:]))
+    return segments
+
+def get_template(filename_template=None):
+    """Return parsed template, templates are kept until their files are modified
+    @Parameters:
+        filename_template : HTML template, None for the default template
+    @Return:
+        list of (kind, text) given by __parse_template
+    """
+    mtime = None
+    if filename_template is not None:
+        mtime = os.stat(filename_template).st_mtime
+    cached = _template_cache.get(filename_template, None)
+    if cached is not None and cached[0] == mtime:
+        return cached[1]
+    if filename_template is None:
+        contents = __get_default_contents()
+    else:
+        with open(filename_template) as fi:
+            contents = fi.read()
+    segments = __parse_template(contents)
+    _template_cache[filename_template] = (mtime, segments)
+    return segments
+
+def __get_report_executor():
+    """Process pool kept for following reports, None if images are drawn sequentially"""
+    global _report_executor
+    num_jobs = _report_jobs if _report_jobs is not None else (os.cpu_count() or 1)
+    if num_jobs <= 1:
+        return None
+    if _report_executor is None:
+        _report_executor = concurrent.futures.ProcessPoolExecutor(min(num_jobs, 3)) # at most three images in a report
+    return _report_executor
+
+def generate_report_document(data, destination, filename_template=None, timestamp=None, page_size=None):
     """Convert results into HTML document
+    Images are drawn in parallel by a process pool while texts and tables are written.
     @Parameters:
         data : dict object containing parameters, data and predicted results
         destination : directory name for output
         filename_template : HTML template if you customize output
+        page_size : number of rows of the data table in the document, following rows are written into page files
     @Return:
         filename of HTML report
     """
-    if filename_template is None:
-        contents = __get_default_contents()
-    else:
-        contents = ''
-        with open(filename_template) as fi:
-            contents += fi.readline().strip()
-    if os.path.exists(destination) is None:
+    global _report_executor
+    segments = get_template(filename_template)
+    if not os.path.exists(destination):
         os.makedirs(destination)
     if timestamp is None:
         timestamp = __get_timestamp()
     filename_report = os.path.join(destination, 'report_{}.html'.format(timestamp))
-    pat = re.compile('<%(.*?)%>', re.M)
-    pos = 0
-    def escape_html(txt):
-        txt.sub('<', '&lt;').replace('>', '&')
-        return txt
+
+    # start drawing all images
+    executor = __get_report_executor()
+    assets = {}
+    for kind, label in segments:
+        if kind != 'key' or label in assets: continue
+        asset = __get_report_asset(label, data, destination, timestamp)
+        if asset is None: continue
+        element, function, kwargs = asset
+        future = None
+        if executor is not None:
+            try:
+                future = executor.submit(function, **kwargs)
+            except RuntimeError: # broken pool
+                _report_executor = executor = None
+        assets[label] = element, function, kwargs, future
+
     with open(filename_report, 'w') as fo:
-        while 1:
-            m = pat.search(contents, pos)
-            if m is None: break
-            fo.write(contents[pos:m.start()])
-            label= m.group(1).strip()
-            if label[0] == '=':
-                value = data.get(label[1:].strip(), None)
+        for kind, label in segments:
+            if kind == 'text':
+                fo.write(label)
+            elif kind == 'value':
+                value = data.get(label, None)
                 if value is not None:
                     fo.write(urllib2.quote(value))
+            elif label in assets:
+                fo.write(assets[label][0])
+            elif label == 'datatable' and 'analysisset' in data:
+                write_data_table(fo, data, data.get('field', None), page_size, destination, timestamp)
+            else:
+                fo.write(generate_report(label, data, destination, timestamp=timestamp))
+    for label, (element, function, kwargs, future) in assets.items():
+        try:
+            if future is None:
+                function(**kwargs)
             else:
-                fo.write(generate_report(label.strip(), data, destination, timestamp=timestamp))#contents(key, dat.get(value, None))
-            pos = m.end()
-        fo.write(contents[pos:])
+                future.result()
+        except Exception as e:
+            sys.stderr.write('ERROR in {} :{}\n'.format(label, repr(e)))
+            raise
     return filename_report
 
 if __name__ == '__main__':
@@ -438,7 +696,8 @@ if __name__ == '__main__':
     parser.add_argument('-i', default=sys.argv[1], help='JSON file')
     parser.add_argument('-o', default='out', help='output directory')
     parser.add_argument('-t', default=None, help='output directory')
-    args.parse_args()
+    parser.add_argument('-p', default=None, type=int, metavar='number', help='number of rows of the data table in a page')
+    args = parser.parse_args()
     with open(args.i) as fi:
         data = json.load(fi)
     if 'title' not in data:
@@ -448,4 +707,4 @@ if __name__ == '__main__':
         else:
             title = fn
         data['title'] = title
-    generate_report_document(data, args.o, args.t)
+    generate_report_document(data, args.o, args.t, page_size=args.p)